@@ -1 +1,32 @@
+# Control of the ALICPT Fourier transform spectrometer
+#
+# The main classes are imported on first access, so that importing the
+# package loads no hardware library (see backends).
 
+import importlib
+
+_EXPORTS = {
+    'AlicptFTS': '.alicptfts',
+    'FTSState': '.alicptfts',
+    'NewportXPS': '.newportxps',
+    'XPSException': '.newportxps',
+    'XPSSimulator': '.xpssim',
+    'read_gathering': '.gathering',
+    'ScanArchive': '.archive',
+    'write_archive': '.archive',
+    'segment_sweeps': '.sweeps',
+    'Spectrometer': '.spectrum',
+    'LiveReducer': '.live',
+    'MC2000B': '.mc2000b',
+    'MC2000BSimulator': '.mc2000bsim',
+}
+
+def __getattr__(name):
+    try:
+        module = _EXPORTS[name]
+    except KeyError:
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+    return getattr(importlib.import_module(module, __name__), name)
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
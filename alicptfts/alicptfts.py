@@ -1,11 +1,10 @@
+from . import backends
+from .archive import write_archive
+from .gathering import read_gathering
+from .newportxps import NewportXPS, XPSException
 
-import sys
-sys.path.append(r'../lib')
-
-import MC2000B_COMMAND_LIB as mc2000b
-from newportxps import NewportXPS, XPSException
-
-import traceback
+from collections import OrderedDict
+import numpy as np
 from enum import Enum
 
 class FTSState(Enum):
@@ -20,18 +19,16 @@ class IR518:
     def __init__(self):
         pass
 
-class MC2000B:
-    def __init__(self):
-        pass
-
 class AlicptFTS:
     def __init__(self):
         self.source = None
         self.chopper = None
         self.newportxps = None
+        self.gathering = None       # gathering data streamed during a scan
+        self.chopper_log = None     # chopper samples taken during a scan
         self.state = FTSState.NOTINIT
 
-    def initialize(self, **kwargs):
+    def initialize(self, chopper=None, source=None, chopper_port=None, **kwargs):
         """Establish connection with each part.
         
         Parameters
@@ -51,13 +48,41 @@ class AlicptFTS:
         username : string (default is Administrator)
 
         password : string (default is Administrator)
+
+        backend : string
+            XPS command interface, 'native' (default) or 'clr'.
+
+        warm : bool
+            If True, keep the homing of the groups that are already
+            referenced (default is False).
+
+        chopper, source : string, optional
+            Backends of the chopper and of the source (default is the
+            first registered one, 'mc2000b' and 'ir518'); see
+            backends.register.
+
+        chopper_port : string, optional
+            Serial port of the chopper, e.g. '/dev/ttyUSB0'. If None,
+            the chopper is not connected.
         """
         self.check_state('initialize')
 
-        # TODO
-        # Current implementation considers only the XPS controller
-        self.source = IR518()
-        self.chopper = MC2000B()
+        if self.chopper is not None:    # from a previous initialize
+            try:
+                self.chopper.stop_monitor()
+            except Exception:
+                pass
+            try:
+                self.chopper.close()
+            except Exception:
+                pass
+        self.source = backends.create('source', source)
+        self.chopper = backends.create('chopper', chopper)
+        if chopper_port is not None:
+            try:
+                self.chopper.connect(chopper_port)
+            except Exception:
+                pass
         if self.newportxps is None:     # Start a new connection
             try:
                 self.newportxps = NewportXPS(**kwargs)
@@ -65,7 +90,7 @@ class AlicptFTS:
                 pass
         else:                           # From a reboot
             try:
-                self.newportxps.initialize()
+                self.newportxps.initialize(warm=True)
             except Exception:
                 pass
 
@@ -100,7 +125,8 @@ class AlicptFTS:
 
         self.state = FTSState.CONFIG
 
-    def scan(self, scan_params=None, scan_range=None, repeat=15):
+    def scan(self, scan_params=None, scan_range=None, repeat=15, reducer=None,
+             extra_types=()):
         """Perform a scan with the configured stages.
         
         Parameters
@@ -120,6 +146,23 @@ class AlicptFTS:
 
         repeat : int
             Number of full back-and-forth scans (default is 15).
+
+        reducer : live.LiveReducer, optional
+            If given, it is started, fed with the gathering blocks as
+            they are downloaded and stopped after the scan, so that its
+            observers see the spectrum sweep by sweep.
+
+        extra_types : list of string
+            Gathering types appended to the motion ones, e.g. the
+            detector signal (see NewportXPS.scan).
+
+        The gathering data are downloaded while scanning and kept in
+        self.gathering, so that "save()" writes them without a
+        post-scan download.
+
+        If the chopper is connected, its lock state and frequencies
+        are sampled in the background during the scan and kept in
+        self.chopper_log (see MC2000B.start_monitor).
         """
         self.check_state('scan')
         try:
@@ -128,18 +171,48 @@ class AlicptFTS:
             pass
         
         self.state = FTSState.SCANNING
+        blocks = []
+        self.gathering = None
+        self.chopper_log = None
+        monitor = getattr(self.chopper, 'is_connected', lambda: False)()
+        if monitor:
+            try:
+                self.chopper.start_monitor()
+            except Exception:
+                monitor = False
+        def on_block(block):
+            blocks.append(block)
+            if reducer is not None:
+                reducer.submit(block)
+        if reducer is not None:
+            reducer.start()
         try:
-            timestamps = self.newportxps.scan(scan_range=scan_range, repeat=repeat)
+            timestamps = self.newportxps.scan(scan_range=scan_range, repeat=repeat,
+                                              callback=on_block, extra_types=extra_types)
         except XPSException:
             pass
         except Exception:
             self.state = FTSState.NOTINIT
             pass
         else:
+            if blocks:
+                self.gathering = np.concatenate(blocks)
             self.state = FTSState.FINISH
             return timestamps
-
-    def save(self, timestamps=None, tname='TIMESTAMPS.DAT', fname='GATHERING.DAT'):
+        finally:
+            if reducer is not None:
+                try:
+                    reducer.stop()
+                except Exception:
+                    pass
+            if monitor:
+                try:
+                    self.chopper_log = self.chopper.stop_monitor()
+                except Exception:
+                    pass
+
+    def save(self, timestamps=None, tname='TIMESTAMPS.DAT', fname='GATHERING.DAT',
+             lname='LEGS.DAT', cname='CHOPPER.DAT', aname='SCAN.FTS', compression=None):
         """Save the gathering data and timestamps after a scan.
         
         Parameters
@@ -156,10 +229,32 @@ class AlicptFTS:
             Name of the file storing the gathering data, including
             encoder positions and velocities (default is 
             'GATHEIRNG.DAT'). Can specify absolute path.
+
+        lname: string
+            Name of the file storing the first and last gathering
+            sample of every leg of the scan (default is 'LEGS.DAT').
+            Can specify absolute path.
+
+        cname: string
+            Name of the file storing the chopper samples taken during
+            the scan, if any (default is 'CHOPPER.DAT'). Can specify
+            absolute path.
+
+        aname: string
+            Name of the archive holding all of the above and the
+            metadata of the scan in one binary file (default is
+            'SCAN.FTS', None to skip); see archive.ScanArchive.
+
+        compression: string
+            Lossless compression of the position channels in the
+            archive, 'zlib' or 'lzma' (default is None).
         """
         self.check_state('save')
         try:
-            self.newportxps.save_gathering(fname)
+            if self.gathering is not None:      # streamed during the scan
+                self.save_gathering(self.gathering, fname)
+            else:                               # nothing streamed, download the file
+                self.newportxps.save_gathering(fname)
         except Exception:
             pass
 
@@ -169,6 +264,24 @@ class AlicptFTS:
             except Exception:
                 pass
 
+        if self.newportxps.leg_indices is not None:
+            try:
+                self.save_legs(self.newportxps.leg_indices, lname)
+            except Exception:
+                pass
+
+        if self.chopper_log is not None:
+            try:
+                self.save_chopper(self.chopper_log, cname)
+            except Exception:
+                pass
+
+        if aname is not None:
+            try:
+                self.save_archive(aname, timestamps, fname, compression)
+            except Exception:
+                pass
+
     def reboot(self):
         """Reboot the system to the NOTINIT state"""
         self.check_state('reboot')
@@ -185,9 +298,11 @@ class AlicptFTS:
         """
         self.check_state('stop')
         try:
-            self.newportxps.stop_all()
+            stop_time = self.newportxps.stop_all()
         except Exception:
             pass
+        else:
+            print('All motions stopped in {0:.1f} ms'.format(1000 * stop_time))
     
     def pause(self):
         """Temporarily hold the system from further actions
@@ -231,12 +346,70 @@ class AlicptFTS:
             pass
 
     ## Helper functions
+    def save_gathering(self, data, fname):
+        """Write streamed gathering data in the format of GATHERING.DAT"""
+        try:
+            np.savetxt(fname, data, fmt='%.10g', delimiter='\t',
+                       header='\t'.join(self.newportxps.gathering_types), comments='')
+        except Exception:
+            raise
+
     def save_timestamps(self, timestamps, tname):
         try:
             np.savetxt(tname, np.array(timestamps), delimiter=' ')
         except Exception:
             raise
 
+    def save_legs(self, legs, lname):
+        try:
+            np.savetxt(lname, legs, fmt='%d', delimiter=' ')
+        except Exception:
+            raise
+
+    def save_chopper(self, samples, cname):
+        """Write the chopper samples with their time.time() timestamps"""
+        try:
+            epoch = self.chopper.monitor.epoch
+            columns = [samples['time'] + epoch] + [samples[n] for n in samples.dtype.names[1:]]
+            np.savetxt(cname, np.column_stack(columns), fmt=['%.6f'] + ['%d'] * (len(columns) - 1),
+                       delimiter=' ', header=' '.join(samples.dtype.names), comments='')
+        except Exception:
+            raise
+
+    def save_archive(self, aname, timestamps, fname, compression=None):
+        """Write the data and metadata of the last scan to one archive
+
+        The gathering data are those streamed during the scan or else
+        those of fname, already saved by "save()".
+        """
+        types = self.newportxps.gathering_types
+        channels = OrderedDict()
+        try:
+            if self.gathering is not None:
+                for k, name in enumerate(types):
+                    channels[name] = self.gathering[:, k]
+            else:
+                data = read_gathering(fname, types=types)
+                for name in data.dtype.names:
+                    channels[name] = data[name]
+        except Exception:
+            raise
+        if timestamps is not None:
+            channels['Timestamps'] = np.asarray(timestamps)
+        if self.newportxps.leg_indices is not None:
+            channels['Legs'] = self.newportxps.leg_indices
+
+        metadata = self.newportxps.scan_metadata()
+        if self.chopper_log is not None:
+            for name in self.chopper_log.dtype.names:
+                channels['Chopper.' + name] = self.chopper_log[name]
+            metadata['chopper'] = OrderedDict([('epoch', self.chopper.monitor.epoch),
+                                               ('settings', dict(self.chopper.settings))])
+        try:
+            write_archive(aname, channels, metadata, compression=compression)
+        except Exception:
+            raise
+
     # TODO
     # We might want to promote this function to a command
     # if it turns out to be useful during the operation
@@ -264,15 +437,27 @@ class AlicptFTS:
     ## TODO
     def check_state(self, command):
         if command == 'initialize':
+            pass
         elif command == 'configure':
+            pass
         elif command == 'scan':
+            pass
         elif command == 'save':
+            pass
         elif command == 'reboot':
+            pass
         elif command == 'stop':
+            pass
         elif command == 'pause':
+            pass
         elif command == 'resume':
+            pass
         elif command == 'status':
+            pass
         elif command == 'close':
+            pass
+        elif command == 'set_motion_params':
+            pass
         else:
             raise ValueError('Error: Invalid command')
 
@@ -0,0 +1,202 @@
+# Archive of a scan in a single binary file
+#
+# Layout (little endian):
+#   MAGIC (8 bytes) | header length (uint64) | JSON header | channels
+# The header holds the metadata of the scan and, for every channel,
+# its dtype, shape, codec and the offset of its bytes from the start
+# of the channels. Every channel starts on an ALIGN boundary, so that
+# an uncompressed channel is opened as a memory map and a compressed
+# one is read and decompressed without touching the other channels.
+#
+# Compressed channels go through a delta filter on the integer view
+# of the values (exact for floats too, the cumulative sum wraps like
+# the differences) and a byte shuffle before zlib or lzma.
+#
+# Example
+# -------
+# write_archive('SCAN.FTS', {'Timestamps': ts, 'Position': pos},
+#               metadata={'repeat': 15}, compression='zlib')
+# with ScanArchive('SCAN.FTS') as scan:
+#     pos = scan['Position']
+
+import json
+import lzma
+import os
+import struct
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+MAGIC = b'ALIFTSA1'
+ALIGN = 64
+COMPRESSIONS = ('zlib', 'lzma')
+
+_PREFIX = struct.Struct('<8sQ')
+
+def _padding(offset):
+    return -offset % ALIGN
+
+def _int_dtype(dtype):
+    return np.dtype('<i{0}'.format(dtype.itemsize))
+
+def encode(array, compression):
+    """Delta filter, byte shuffle and compression of a 1-D or N-D array"""
+    flat = array.reshape(-1)
+    if flat.dtype.kind in 'iuf' and flat.dtype.itemsize in (1, 2, 4, 8):
+        ints = flat.view(_int_dtype(flat.dtype))
+        data = np.empty_like(ints)
+        data[:1] = ints[:1]
+        np.subtract(ints[1:], ints[:-1], out=data[1:])     # wraps around
+        delta = True
+    else:
+        data = flat
+        delta = False
+    shuffled = data.view(np.uint8).reshape(-1, data.dtype.itemsize).T.tobytes()
+    if compression == 'zlib':
+        payload = zlib.compress(shuffled, 6)
+    elif compression == 'lzma':
+        payload = lzma.compress(shuffled, preset=6)
+    else:
+        raise ValueError('Error: Unknown compression {0}, use one of {1}'.format(
+                         compression, COMPRESSIONS))
+    return payload, {'filter': 'delta' if delta else None, 'compression': compression}
+
+def decode(payload, codec, dtype, shape):
+    """Inverse of encode"""
+    if codec['compression'] == 'zlib':
+        shuffled = zlib.decompress(payload)
+    else:
+        shuffled = lzma.decompress(payload)
+    itemsize = dtype.itemsize
+    data = np.frombuffer(shuffled, np.uint8).reshape(itemsize, -1).T.copy()
+    if codec['filter'] == 'delta':
+        ints = data.view(_int_dtype(dtype)).reshape(-1)
+        values = np.cumsum(ints, dtype=ints.dtype).view(dtype)
+    else:
+        values = data.view(dtype).reshape(-1)
+    return values.reshape(shape)
+
+def write_archive(fname, channels, metadata=None, compression=None, compress=None):
+    """Write arrays and metadata to a scan archive
+
+    Parameters
+    ----------
+    fname : string
+        Archive file, replaced atomically.
+
+    channels : dict of {string : array}
+        Arrays to store (not structured), in order.
+
+    metadata : dict, optional
+        JSON serializable description of the scan.
+
+    compression : string, optional
+        'zlib' or 'lzma' to compress the channels in compress (default
+        is None, no compression).
+
+    compress : list of string, optional
+        Channels to compress (default is those whose name ends with
+        'Position').
+
+    Returns
+    -------
+    Size of the archive in bytes.
+    """
+    if compress is None:
+        compress = [name for name in channels if name.endswith('Position')]
+    entries = []
+    blocks = []
+    offset = 0
+    for name, array in channels.items():
+        array = np.asarray(array)
+        if array.dtype.names is not None or array.dtype.hasobject:
+            raise ValueError('Error: Channel {0} must be a plain numeric array'.format(name))
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+        entry = OrderedDict([('name', name), ('dtype', array.dtype.str),
+                             ('shape', list(array.shape)), ('codec', None)])
+        if compression is not None and name in compress and array.size:
+            payload, entry['codec'] = encode(array, compression)
+        else:
+            payload = array.tobytes()
+        entry['offset'] = offset
+        entry['nbytes'] = len(payload)
+        entries.append(entry)
+        blocks.append(payload)
+        offset += len(payload) + _padding(len(payload))
+
+    header = json.dumps(OrderedDict([('metadata', metadata or {}),
+                                     ('channels', entries)])).encode('utf-8')
+    tmpfile = fname + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, len(header)))
+        f.write(header)
+        f.write(b'\0' * _padding(_PREFIX.size + len(header)))
+        for payload in blocks:
+            f.write(payload)
+            f.write(b'\0' * _padding(len(payload)))
+        size = f.tell()
+    os.replace(tmpfile, fname)
+    return size
+
+class ScanArchive:
+    """Read access to a scan archive
+
+    Channels are read on demand: an uncompressed channel is returned as
+    a read-only memory map, a compressed one is decompressed once and
+    kept.
+
+    Parameters
+    ----------
+    fname : string
+        Archive written by write_archive.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            magic, length = _PREFIX.unpack(f.read(_PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError('Error: {0} is not a scan archive'.format(fname))
+            header = json.loads(f.read(length).decode('utf-8'),
+                                object_pairs_hook=OrderedDict)
+        self.metadata = header['metadata']
+        self.channels = OrderedDict((c['name'], c) for c in header['channels'])
+        self._start = _PREFIX.size + length + _padding(_PREFIX.size + length)
+        self._decoded = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.channels
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def keys(self):
+        return self.channels.keys()
+
+    def __getitem__(self, name):
+        try:
+            entry = self.channels[name]
+        except KeyError:
+            raise KeyError('Error: No channel {0} in {1}'.format(name, self.fname))
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        offset = self._start + entry['offset']
+        if entry['codec'] is None:
+            if entry['nbytes'] == 0:
+                return np.empty(shape, dtype)
+            return np.memmap(self.fname, dtype=dtype, mode='r', offset=offset, shape=shape)
+        if name not in self._decoded:
+            with open(self.fname, 'rb') as f:
+                f.seek(offset)
+                payload = f.read(entry['nbytes'])
+            self._decoded[name] = decode(payload, entry['codec'], dtype, shape)
+        return self._decoded[name]
+
+    def close(self):
+        self._decoded = {}
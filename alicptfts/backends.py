@@ -0,0 +1,72 @@
+# Registry of the hardware backends
+#
+# Each kind of hardware has named backends. A backend is a factory
+# (class or function) given either directly or as 'module:attribute',
+# in which case the module is only imported the first time the
+# backend is used. Nothing hardware specific (DLL, CLR, SFTP) is
+# therefore loaded by importing alicptfts, and simulators can be
+# registered in place of the hardware, e.g.
+#
+# backends.register('chopper', 'mine', 'mypackage.chopper:Chopper')
+# fts.initialize(chopper='mine', ...)
+
+import importlib
+from collections import OrderedDict
+
+KINDS = ('xps', 'chopper', 'source')
+
+_registry = OrderedDict((kind, OrderedDict()) for kind in KINDS)
+_defaults = {}
+
+def register(kind, name, factory, default=False):
+    """Register a backend
+
+    Parameters
+    ----------
+    kind : string
+        One of KINDS.
+
+    name : string
+        Name of the backend, e.g. 'native'.
+
+    factory : callable or string
+        Creates the driver object, or 'module:attribute' to import it
+        on first use. Relative module names are resolved in alicptfts.
+
+    default : bool
+        If True, use this backend when none is named (the first
+        registered backend of a kind is the default otherwise).
+    """
+    if kind not in _registry:
+        raise ValueError('Error: Unknown backend kind {0}, use one of {1}'.format(kind, KINDS))
+    _registry[kind][name] = factory
+    if default or kind not in _defaults:
+        _defaults[kind] = name
+
+def available(kind):
+    """Names of the registered backends of a kind"""
+    return tuple(_registry[kind])
+
+def get(kind, name=None):
+    """Return the factory of a backend, importing it if needed"""
+    if name is None:
+        name = _defaults[kind]
+    try:
+        factory = _registry[kind][name]
+    except KeyError:
+        raise ValueError('Error: Unknown {0} backend {1}, use one of {2}'.format(kind, name,
+                                                                              available(kind)))
+    if isinstance(factory, str):
+        module, _, attr = factory.partition(':')
+        factory = getattr(importlib.import_module(module, __package__), attr)
+        _registry[kind][name] = factory
+    return factory
+
+def create(kind, name=None, *args, **kwargs):
+    """Create a driver object with the factory of a backend"""
+    return get(kind, name)(*args, **kwargs)
+
+register('xps', 'native', '.xpsclient:XPS')
+register('xps', 'clr', '.newportxps:_clr_xps')
+register('chopper', 'mc2000b', '.mc2000b:MC2000B')
+register('source', 'ir518', '.alicptfts:IR518')
@@ -0,0 +1,153 @@
+# Loader of the GATHERING.DAT files of the XPS
+#
+# GATHERING.DAT holds a header line with the gathering types set by
+# GatheringConfigurationSet (e.g. MovingLinear.Pos.CurrentPosition),
+# then one line of tab-separated numbers per sample. read_gathering
+# parses it into a NumPy structured array with one field per type and
+# caches the result next to the file as a .npy sidecar, which is then
+# opened as a memory map instead of parsing the text again. The size
+# and modification time of the file are kept in a .json stamp next to
+# the sidecar, so that a file replaced by another one is parsed again.
+#
+# Example
+# -------
+# data = read_gathering('GATHERING.DAT')
+# data['CurrentPosition']           # or data['MovingLinear.Pos.CurrentPosition']
+
+import json
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .sftpwrapper import iter_arrays
+
+# Type of the gathered values, by the last part of the gathering type
+# (XPS Programming Manual, GatheringConfigurationSet). Others are double.
+GATHERING_DTYPES = {
+    'DI': 'i4',                     # GPIOn.DI, digital inputs
+    'DO': 'i4',                     # GPIOn.DO, digital outputs
+    'ExternalLatchCounter': 'i4',
+}
+
+SIDECAR_SUFFIX = '.npy'
+STAMP_SUFFIX = '.json'
+
+def gathering_dtype(types):
+    """Structured dtype of the samples of a list of gathering types
+
+    The fields are named by the full types. When the last part of a
+    type (e.g. CurrentPosition) is unique, it is also a title of the
+    field, so that it can be used as a shorter name.
+    """
+    kinds = [t.rpartition('.')[2] for t in types]
+    fields = []
+    for gtype, kind in zip(types, kinds):
+        fmt = GATHERING_DTYPES.get(kind, 'f8')
+        if kind != gtype and kinds.count(kind) == 1 and kind not in types:
+            fields.append(((kind, gtype), fmt))
+        else:
+            fields.append((gtype, fmt))
+    return np.dtype(fields)
+
+def read_gathering(fname, types=None, chunk_size=1 << 22, cache=True):
+    """Read a GATHERING.DAT file into a structured array
+
+    The number of samples is counted first, so that the array is
+    allocated once (in the .npy sidecar if cache is True) and filled
+    chunk_size bytes of text at a time.
+
+    Parameters
+    ----------
+    fname : string
+        Local GATHERING.DAT file.
+
+    types : list of string, optional
+        Gathering types configured for the scan. If given, the header
+        of the file must match them.
+
+    chunk_size : int
+        Bytes of text parsed at a time (default is 4 MB).
+
+    cache : bool
+        If True (default), save the array as fname + '.npy' and, when
+        the file has the size and modification time stamped with that
+        sidecar and the sidecar has the fields of types, return it as
+        a read-only memory map without parsing the file.
+
+    Returns
+    -------
+    Structured array with one field per gathering type.
+    """
+    sidecar = fname + SIDECAR_SUFFIX
+    stamp = _source_stamp(fname)
+    if cache and _read_stamp(sidecar) == stamp:
+        try:
+            data = np.load(sidecar, mmap_mode='r')
+        except (OSError, ValueError):
+            data = None             # damaged, parse again
+        if data is not None and (types is None or data.dtype == gathering_dtype(types)):
+            return data
+
+    with open(fname, 'rb') as f:
+        names = f.readline().decode('latin-1').split()
+        if types is not None and list(types) != names:
+            raise ValueError('Error: Gathering types of {0} are {1}, expected {2}'.format(
+                             fname, names, list(types)))
+        dtype = gathering_dtype(names)
+        start = f.tell()
+        nrows = count_lines(f, chunk_size)
+        f.seek(start)
+
+        tmpfile = sidecar + '.tmp'
+        if cache:
+            data = open_memmap(tmpfile, mode='w+', dtype=dtype, shape=(nrows,))
+        else:
+            data = np.empty(nrows, dtype=dtype)
+        row = 0
+        for block in iter_arrays(f, len(names), block_size=chunk_size):
+            if row + len(block) > nrows:
+                raise ValueError('Error: {0} changed while being read'.format(fname))
+            for k, name in enumerate(dtype.names):
+                data[name][row:row + len(block)] = block[:, k]
+            row += len(block)
+
+    if not cache:
+        return data[:row]
+    if row != nrows:                # blank lines were counted
+        np.save(tmpfile + SIDECAR_SUFFIX, data[:row])
+        del data
+        os.replace(tmpfile + SIDECAR_SUFFIX, tmpfile)
+    else:
+        data.flush()
+        del data
+    os.replace(tmpfile, sidecar)
+    _write_stamp(sidecar, stamp)
+    return np.load(sidecar, mmap_mode='r')
+
+def _source_stamp(fname):
+    """[size, mtime in ns] of a file"""
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+def _read_stamp(sidecar):
+    try:
+        with open(sidecar + STAMP_SUFFIX) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def _write_stamp(sidecar, stamp):
+    with open(sidecar + STAMP_SUFFIX + '.tmp', 'w') as f:
+        json.dump(stamp, f)
+    os.replace(sidecar + STAMP_SUFFIX + '.tmp', sidecar + STAMP_SUFFIX)
+
+def count_lines(f, chunk_size=1 << 22):
+    """Number of lines from the position of the binary file object f"""
+    count = 0
+    last = b'\n'
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        count += chunk.count(b'\n')
+        last = chunk[-1:]
+    if last != b'\n':               # no newline at the end
+        count += 1
+    return count
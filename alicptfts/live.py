@@ -0,0 +1,231 @@
+# Spectrum updated live from the gathering blocks of a running scan
+#
+# LiveReducer.submit() is given the blocks of GatheringStream (see
+# NewportXPS.scan(callback=...)) and only queues them; a worker thread
+# cuts the samples into sweeps at the turnarounds (sign changes of the
+# velocity), reduces every completed sweep with a Spectrometer and
+# updates a running mean and noise of the spectrum. Only the current
+# sweep and the running sums are kept, so memory does not depend on
+# the number of sweeps. Observers are called from the worker thread
+# with a LiveSpectrum after every sweep.
+#
+# Example
+# -------
+# reducer = LiveReducer(Spectrometer(), sgamma=xps.get_motion_params('MovingLinear'))
+# reducer.subscribe(lambda live: print(live.count, live.frequency[live.spectrum.argmax()]))
+# reducer.start()
+# xps.scan(scan_range, repeat, callback=reducer.submit, extra_types=['GPIO2.ADC1'])
+# reducer.stop()
+
+import queue
+import threading
+import traceback
+from collections import namedtuple
+
+import numpy as np
+
+from .spectrum import C_MM_NS, Spectrometer
+from .sweeps import accel_distance, trim_sweeps
+
+# Fraction of the OPD reach of the first sweep left out of the grid,
+# so that later sweeps slightly shorter than the first still cover it
+GRID_MARGIN = 0.01
+
+LiveSpectrum = namedtuple('LiveSpectrum', ['count', 'rejected', 'wavenumber', 'frequency',
+                                           'spectrum', 'noise', 'last'])
+
+class LiveReducer:
+    """Incremental co-added spectrum of the sweeps of a scan
+
+    Parameters
+    ----------
+    spectrometer : Spectrometer, optional
+        Reduction settings (default is Spectrometer()). The OPD grid
+        and ZPD are fixed by the first complete sweep (its dx and
+        opd_max are set until reset()); later sweeps that do not cover
+        that grid are rejected.
+
+    sgamma : list or dict, optional
+        SGamma parameters of the scan, to trim the acceleration zones
+        (see sweeps.accel_distance).
+
+    position_col, velocity_col, signal_col : int
+        Columns of the position, velocity and detector signal in the
+        blocks (default is 0, 1 and 4, the first extra gathering type
+        of NewportXPS.scan).
+
+    threshold : float
+        Velocities below threshold times the largest velocity seen
+        are at rest (default is 0.01, see sweeps.find_sweeps).
+
+    min_samples : int
+        Shorter sweeps are ignored (default is 16).
+
+    zpd : float, optional
+        Stage position of ZPD (default is found on the first sweep).
+    """
+    def __init__(self, spectrometer=None, sgamma=None, position_col=0, velocity_col=1,
+                 signal_col=4, threshold=0.01, min_samples=16, zpd=None):
+        self.spectrometer = spectrometer if spectrometer is not None else Spectrometer()
+        self.distance = accel_distance(sgamma) if sgamma is not None else 0.0
+        self.columns = (position_col, velocity_col, signal_col)
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.zpd = zpd
+        self._zpd = zpd
+        self.observers = []
+        self.latest = None              # LiveSpectrum of the last update
+        self._settings = (self.spectrometer.dx, self.spectrometer.opd_max)
+        self._queue = queue.Queue()
+        self._thread = None
+        self.reset()
+
+    def reset(self):
+        """Forget the sweeps (keeps the observers and settings)"""
+        self.count = 0                  # co-added sweeps
+        self.rejected = 0               # complete sweeps not on the grid
+        self._grid = None               # (m, dx) fixed by the first sweep
+        self._wavenumber = None
+        self._mean = None
+        self._m2 = None
+        self._vmax = 0.0
+        self._sign = 0                  # direction of the current sweep
+        self._current = []              # blocks (position, signal, sign) of the current sweep
+        self.zpd = self._zpd
+        self.spectrometer.dx, self.spectrometer.opd_max = self._settings
+
+    def subscribe(self, observer):
+        """Call observer(LiveSpectrum) after every co-added sweep"""
+        self.observers.append(observer)
+
+    def unsubscribe(self, observer):
+        self.observers.remove(observer)
+
+    ## Worker
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='livereducer', daemon=True)
+        self._thread.start()
+
+    def submit(self, block):
+        """Queue a gathering block of shape (n, ncols); returns at once"""
+        self._queue.put(block)
+
+    def stop(self, flush=True):
+        """Process the queued blocks and wait for the worker
+
+        If flush, the last sweep is reduced even without a turnaround
+        after it.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if flush:
+            self._complete()
+        return self.latest
+
+    def _run(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                return
+            try:
+                self.feed(block)
+            except Exception:
+                traceback.print_exc()
+
+    ## Reduction
+    def feed(self, block):
+        """Process a block in the calling thread"""
+        block = np.asarray(block, dtype=float)
+        if block.ndim != 2 or len(block) == 0:
+            return
+        pcol, vcol, scol = self.columns
+        pos, vel, sig = block[:, pcol], block[:, vcol], block[:, scol]
+        self._vmax = max(self._vmax, float(np.abs(vel).max()))
+        limit = self.threshold * self._vmax
+        sign = np.where(vel > limit, 1, np.where(vel < -limit, -1, 0))
+
+        # Turnarounds: first moving sample of the opposite direction
+        moving = np.flatnonzero(sign)
+        cuts = []
+        direction = self._sign
+        if len(moving):
+            signs = sign[moving]
+            change = np.flatnonzero(signs[1:] != signs[:-1]) + 1
+            if direction != 0 and signs[0] != direction:
+                cuts.append(moving[0])
+            cuts.extend(moving[change])
+            direction = int(signs[-1])
+
+        start = 0
+        for cut in cuts:
+            self._append(pos[start:cut], sig[start:cut], sign[start:cut])
+            self._complete()
+            start = cut
+        self._append(pos[start:], sig[start:], sign[start:])
+        self._sign = direction
+
+    def _append(self, pos, sig, sign):
+        if len(pos):
+            self._current.append((pos.copy(), sig.copy(), sign.copy()))
+
+    def _complete(self):
+        """Reduce the current sweep and update the running spectrum"""
+        blocks, self._current = self._current, []
+        if not blocks:
+            return
+        pos = np.concatenate([b[0] for b in blocks])
+        sig = np.concatenate([b[1] for b in blocks])
+        sign = np.concatenate([b[2] for b in blocks])
+        moving = np.flatnonzero(sign)
+        if len(moving) < self.min_samples:
+            return
+        sweep = np.array([[moving[0], moving[-1] + 1, sign[moving[0]]]])
+        if self.distance:
+            sweep = trim_sweeps(sweep, pos, self.distance)
+            if len(sweep) == 0:
+                self.rejected += 1
+                return
+        s = slice(int(sweep[0, 0]), int(sweep[0, 1]))
+
+        sp = self.spectrometer
+        zpd = self.zpd if self.zpd is not None else sp.find_zpd(pos, sig, [s])
+        try:
+            opd, igm, dx = sp.resample(pos, sig, [s], zpd=zpd)
+        except ValueError:              # does not cover both sides of ZPD
+            self.rejected += 1
+            return
+        m = len(opd) // 2
+        if self._grid is None:
+            m = int(m * (1 - GRID_MARGIN))
+            self._grid = (m, dx)
+            sp.dx, sp.opd_max = dx, (m + 0.5) * dx
+            self.zpd = zpd
+            opd, igm, dx = sp.resample(pos, sig, [s], zpd=zpd)
+        elif m != self._grid[0]:
+            self.rejected += 1
+            return
+
+        wavenumber, spectra = sp.transform(igm, dx)
+        spectrum = spectra[0]
+        self.count += 1
+        if self._mean is None:              # Welford running mean and variance
+            self._wavenumber = wavenumber
+            self._mean = spectrum.copy()
+            self._m2 = np.zeros_like(spectrum)
+        else:
+            delta = spectrum - self._mean
+            self._mean += delta / self.count
+            self._m2 += delta * (spectrum - self._mean)
+        if self.count > 1:
+            noise = np.sqrt(self._m2 / (self.count - 1) / self.count)
+        else:
+            noise = np.full_like(self._mean, np.nan)
+        self.latest = LiveSpectrum(self.count, self.rejected, self._wavenumber,
+                                   self._wavenumber * C_MM_NS, self._mean.copy(), noise, spectrum)
+        for observer in list(self.observers):
+            try:
+                observer(self.latest)
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,455 @@
+# Native Python driver of the Thorlabs MC2000B optical chopper
+#
+# The chopper is controlled with the ASCII command set of its USB
+# virtual serial port (MC2000B manual, Sec. 6): "freq=1000\r" sets a
+# value, "freq?\r" queries it. The chopper echoes every command, then
+# replies with the value (if any) and the prompt "> ".
+#
+# The bytes go through a transport with write(data), read(size) and
+# close(), so that the serial port can be replaced by a pseudo
+# terminal (see mc2000bsim.MC2000BSimulator) or anything else.
+
+import collections
+import os
+import select
+import threading
+import time
+import numpy as np
+
+ENCODING = 'ascii'
+TERMINATOR = b'\r'
+PROMPT = b'> '
+
+# Replies of the chopper to an invalid command
+ERRORS = ('CMD_NOT_DEFINED', 'CMD_ARG_INVALID')
+
+# Settings cached by the driver {name : command}
+SETTINGS = collections.OrderedDict([
+    ('frequency', 'freq'),          # internal reference frequency (Hz)
+    ('blade', 'blade'),             # blade type
+    ('nharmonic', 'nharmonic'),     # harmonic multiplier
+    ('dharmonic', 'dharmonic'),     # harmonic divider
+    ('phase', 'phase'),             # phase adjust (deg)
+    ('reference', 'ref'),           # reference mode, 0 internal, 1 external
+    ('output', 'output'),           # reference output, 0 target, 1 actual
+    ('enable', 'enable'),           # 1 while the blade spins
+])
+
+# Read-only values, never cached
+READINGS = collections.OrderedDict([
+    ('locked', 'lock'),                     # 1 if locked to the reference
+    ('reference_frequency', 'input'),       # external reference frequency (Hz)
+    ('output_frequency', 'refoutfreq'),     # actual blade frequency (Hz)
+])
+
+# Readings sampled by the monitor
+MONITOR_FIELDS = ('locked', 'reference_frequency', 'output_frequency')
+
+class MC2000BException(Exception):
+    """MC2000B Exception"""
+    def __init__(self, msg, *args):
+        self.msg = msg
+    def __str__(self):
+        return str(self.msg)
+
+class SerialTransport:
+    """Serial port through pyserial"""
+    def __init__(self, port, baudrate=115200, timeout=1.0):
+        import serial                   # optional dependency
+        self._serial = serial.Serial(port, baudrate=baudrate, timeout=timeout)
+
+    def write(self, data):
+        self._serial.write(data)
+
+    def read(self, size):
+        data = self._serial.read(max(1, min(size, self._serial.in_waiting)))
+        return data
+
+    def close(self):
+        self._serial.close()
+
+class PosixTransport:
+    """Serial port or pseudo terminal opened as a raw POSIX tty"""
+    def __init__(self, port, baudrate=115200, timeout=1.0):
+        import termios
+        import tty
+        self.timeout = timeout
+        self._fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+        try:
+            tty.setraw(self._fd)
+            attrs = termios.tcgetattr(self._fd)
+            speed = getattr(termios, 'B{0}'.format(baudrate))
+            attrs[4] = attrs[5] = speed
+            termios.tcsetattr(self._fd, termios.TCSANOW, attrs)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def write(self, data):
+        while data:
+            data = data[os.write(self._fd, data):]
+
+    def read(self, size):
+        ready, _, _ = select.select([self._fd], [], [], self.timeout)
+        if not ready:
+            return b''
+        return os.read(self._fd, size)
+
+    def close(self):
+        os.close(self._fd)
+
+def open_transport(port, baudrate=115200, timeout=1.0):
+    """Open a serial port, with pyserial if it is installed"""
+    try:
+        return SerialTransport(port, baudrate, timeout)
+    except ImportError:
+        if os.name != 'posix':
+            raise
+        return PosixTransport(port, baudrate, timeout)
+
+class MC2000B:
+    """Thorlabs MC2000B optical chopper
+
+    The last known value of every setting is cached, so that reading a
+    setting does not talk to the chopper and configure() only writes
+    the settings that changed. snapshot() reads all the settings and
+    readings in one exchange.
+
+    Parameters
+    ----------
+    port : string, optional
+        Serial port of the chopper, e.g. '/dev/ttyUSB0' or 'COM3'. If
+        None, connect() must be called before use.
+
+    transport : object, optional
+        Already open transport to use instead of port.
+
+    baudrate : int
+        Baud rate of the serial port (default is 115200).
+
+    timeout : float
+        Time in seconds to wait for a reply (default is 1.0).
+
+    Example
+    -------
+    chopper = MC2000B('/dev/ttyUSB0')
+    chopper.configure(frequency=1000, reference=0, enable=1)
+    print(chopper.snapshot())
+    """
+    def __init__(self, port=None, transport=None, baudrate=115200, timeout=1.0):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.settings = {}              # cache {setting : value}
+        self.monitor = None
+        self._transport = None
+        self._buffer = b''
+        self._lock = threading.Lock()
+        if port is not None or transport is not None:
+            self.connect(port, transport)
+
+    def connect(self, port=None, transport=None):
+        """Open the serial port (or use transport) and read the settings"""
+        self.close()
+        if transport is None:
+            if port is None:
+                port = self.port
+            try:
+                transport = open_transport(port, self.baudrate, self.timeout)
+            except Exception:
+                print('Error: Could not open the chopper on port {0}'.format(port))
+                raise
+        self.port = port
+        self._transport = transport
+        self._buffer = b''
+        try:
+            self.snapshot()
+        except MC2000BException:
+            raise
+
+    def is_connected(self):
+        return self._transport is not None
+
+    def close(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+        if self._transport is not None:
+            try:
+                self._transport.close()
+            except Exception:
+                pass
+        self._transport = None
+        self.settings = {}
+
+    ## Communication
+    def exchange(self, commands):
+        """Send commands at once and return their replies
+
+        All the commands are written before the first reply is read,
+        so a batch costs a single round trip on the serial port.
+
+        Parameters
+        ----------
+        commands : list of string
+            Commands without terminator, e.g. ['freq?', 'phase=10'].
+
+        Returns
+        -------
+        list of the reply (string, '' for a set command) of each command.
+        """
+        if self._transport is None:
+            raise MC2000BException('Error: Chopper not connected')
+        request = b''.join(c.encode(ENCODING) + TERMINATOR for c in commands)
+        with self._lock:
+            self._transport.write(request)
+            chunks = [self._read_reply() for _ in commands]
+        replies = []
+        for command, chunk in zip(commands, chunks):
+            lines = [l.strip() for l in chunk.decode(ENCODING).replace('\n', '\r').split('\r')]
+            lines = [l for l in lines if l]
+            if lines and lines[0] == command:       # echo
+                lines = lines[1:]
+            reply = ' '.join(lines)
+            if reply in ERRORS:
+                raise MC2000BException('Error: {0} ({1})'.format(reply, command))
+            replies.append(reply)
+        return replies
+
+    def _read_reply(self):
+        """Read up to the next prompt"""
+        while PROMPT not in self._buffer:
+            data = self._transport.read(4096)
+            if not data:
+                self._buffer = b''
+                raise MC2000BException('Error: Timeout waiting for the chopper')
+            self._buffer += data
+        chunk, self._buffer = self._buffer.split(PROMPT, 1)
+        return chunk
+
+    def query(self, name):
+        """Read a setting or a reading from the chopper as an int"""
+        command = SETTINGS.get(name) or READINGS.get(name)
+        if command is None:
+            raise ValueError('Error: Unknown chopper parameter {0}'.format(name))
+        try:
+            value = int(self.exchange([command + '?'])[0])
+        except ValueError:
+            raise MC2000BException('Error: Invalid reply to {0}?'.format(command))
+        if name in SETTINGS:
+            self.settings[name] = value
+        return value
+
+    ## Settings
+    def get(self, name):
+        """Last known value of a setting (queried if unknown)"""
+        if name not in SETTINGS:
+            raise ValueError('Error: Unknown chopper setting {0}'.format(name))
+        if name not in self.settings:
+            return self.query(name)
+        return self.settings[name]
+
+    def set(self, name, value):
+        """Write a setting if it differs from the last known value
+
+        Returns
+        -------
+        True if the setting was written.
+        """
+        return bool(self.configure(**{name: value}))
+
+    def configure(self, **settings):
+        """Write the settings that differ from the last known values
+
+        The writes are sent as one batch, in the order of SETTINGS.
+
+        Returns
+        -------
+        list of the names of the settings that were written.
+        """
+        for name in settings:
+            if name not in SETTINGS:
+                raise ValueError('Error: Unknown chopper setting {0}'.format(name))
+        changed = [name for name in SETTINGS if name in settings
+                   and self.settings.get(name) != int(settings[name])]
+        if not changed:
+            return changed
+        commands = ['{0}={1}'.format(SETTINGS[name], int(settings[name])) for name in changed]
+        try:
+            self.exchange(commands)
+        except MC2000BException:
+            for name in changed:        # state unknown
+                self.settings.pop(name, None)
+            raise
+        for name in changed:
+            self.settings[name] = int(settings[name])
+        return changed
+
+    def snapshot(self):
+        """Read all the settings and readings in one exchange
+
+        Returns
+        -------
+        dict of {name : value} of SETTINGS and READINGS.
+        """
+        names = list(SETTINGS) + list(READINGS)
+        commands = [(SETTINGS.get(n) or READINGS.get(n)) + '?' for n in names]
+        try:
+            values = [int(r) for r in self.exchange(commands)]
+        except ValueError:
+            raise MC2000BException('Error: Invalid reply to the snapshot')
+        snapshot = collections.OrderedDict(zip(names, values))
+        self.settings.update((n, snapshot[n]) for n in SETTINGS)
+        return snapshot
+
+    def invalidate(self):
+        """Forget the cached settings (e.g. after the front panel was used)"""
+        self.settings = {}
+
+    def restore(self):
+        """Restore the factory default settings"""
+        try:
+            self.exchange(['restore'])
+        finally:
+            self.settings = {}
+
+    ## Monitor
+    def start_monitor(self, rate=10.0, size=36000, fields=MONITOR_FIELDS):
+        """Start sampling the lock state and frequencies in the background
+
+        Parameters
+        ----------
+        rate : float
+            Samples per second (default is 10).
+
+        size : int
+            Number of samples kept; older samples are overwritten
+            (default is 36000, one hour at 10 Hz).
+
+        fields : sequence of string
+            Readings sampled (default is MONITOR_FIELDS).
+        """
+        self.stop_monitor()
+        self.monitor = ChopperMonitor(self, rate, size, fields)
+        self.monitor.start()
+        return self.monitor
+
+    def stop_monitor(self):
+        """Stop the monitor and return its samples (None if not running)"""
+        if self.monitor is None:
+            return None
+        self.monitor.stop()
+        return self.monitor.array()
+
+class RingBuffer:
+    """Fixed-size array of the latest records
+
+    Parameters
+    ----------
+    size : int
+        Number of records kept.
+
+    dtype : numpy dtype
+        Type of a record (usually structured).
+    """
+    def __init__(self, size, dtype):
+        self._data = np.zeros(size, dtype=dtype)
+        self._lock = threading.Lock()
+        self.count = 0              # records appended since creation
+
+    def __len__(self):
+        return min(self.count, len(self._data))
+
+    def append(self, record):
+        with self._lock:
+            self._data[self.count % len(self._data)] = record
+            self.count += 1
+
+    def array(self):
+        """Copy of the records kept, oldest first"""
+        with self._lock:
+            start = self.count % len(self._data)
+            if self.count <= len(self._data):
+                return self._data[:self.count].copy()
+            return np.concatenate((self._data[start:], self._data[:start]))
+
+class ChopperMonitor:
+    """Thread sampling readings of an MC2000B into a RingBuffer
+
+    Each sample holds the time.monotonic() of the query and the value
+    of every field; the readings of one sample are queried in a single
+    exchange. Add self.epoch to a monotonic time to get time.time().
+    """
+    def __init__(self, chopper, rate=10.0, size=36000, fields=MONITOR_FIELDS):
+        for name in fields:
+            if name not in READINGS and name not in SETTINGS:
+                raise ValueError('Error: Unknown chopper parameter {0}'.format(name))
+        self.chopper = chopper
+        self.period = 1.0 / rate
+        self.fields = tuple(fields)
+        self.buffer = RingBuffer(size, [('time', 'f8')] + [(n, 'i4') for n in fields])
+        self.errors = 0             # failed samples
+        self.epoch = time.time() - time.monotonic()
+        self._commands = [(READINGS.get(n) or SETTINGS.get(n)) + '?' for n in fields]
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='mc2000bmonitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def is_running(self):
+        return self._thread is not None
+
+    def _run(self):
+        next_time = time.monotonic()
+        while not self._stop.is_set():
+            t_sample = time.monotonic()
+            try:
+                values = [int(v) for v in self.chopper.exchange(self._commands)]
+            except (MC2000BException, ValueError, OSError):
+                self.errors += 1
+            else:
+                self.buffer.append((t_sample,) + tuple(values))
+            next_time += self.period
+            delay = next_time - time.monotonic()
+            if delay < 0:           # fell behind, do not burst
+                next_time = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
+
+    def array(self):
+        """Samples kept, oldest first"""
+        return self.buffer.array()
+
+    def locked_between(self, start, stop):
+        """True if every sample between two time.time() values was locked
+
+        Also False if there is no sample in that interval.
+        """
+        samples = self.array()
+        t = samples['time'] + self.epoch
+        locked = samples['locked'][(t >= start) & (t <= stop)]
+        return len(locked) > 0 and bool(np.all(locked == 1))
+
+def _setting(name):
+    def fget(self):
+        return self.get(name)
+    def fset(self, value):
+        self.set(name, value)
+    return property(fget, fset, doc='{0} (cached, see SETTINGS)'.format(name))
+
+for _name in SETTINGS:
+    setattr(MC2000B, _name, _setting(_name))
+
+def _reading(name):
+    return property(lambda self: self.query(name), doc='{0} (read on access)'.format(name))
+
+for _name in READINGS:
+    setattr(MC2000B, _name, _reading(_name))
@@ -0,0 +1,148 @@
+# Local simulator of a Thorlabs MC2000B optical chopper
+#
+# Answers the ASCII command set of the chopper (see mc2000b.py) on a
+# pseudo terminal, so that MC2000B can be used without the hardware.
+#
+# Example
+# -------
+# sim = MC2000BSimulator()
+# port = sim.start()
+# chopper = MC2000B(port)
+
+import collections
+import os
+import threading
+import time
+
+from .mc2000b import ENCODING, PROMPT, READINGS, SETTINGS, TERMINATOR
+
+DEFAULT_SETTINGS = {
+    'frequency': 1000,
+    'blade': 0,
+    'nharmonic': 1,
+    'dharmonic': 1,
+    'phase': 0,
+    'reference': 0,
+    'output': 0,
+    'enable': 0,
+}
+
+class MC2000BSimulator:
+    """Pseudo terminal emulating an MC2000B chopper
+
+    Parameters
+    ----------
+    latency : float
+        Delay in seconds before every reply (models the USB serial
+        round trip).
+
+    reference_frequency : int
+        Frequency of the simulated external reference in Hz.
+    """
+    def __init__(self, latency=0.0, reference_frequency=0):
+        self.latency = latency
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.reference_frequency = reference_frequency
+        self.locked = 1
+        self.port = None
+
+        # Command statistics: writes of the master side and counts per command
+        self.counts = collections.Counter()
+        self.writes = 0
+
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """Serve in a background thread and return the port name"""
+        import tty
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name='mc2000bsim', daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        if self._master is None:
+            return
+        self._running = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+        self._master = self._slave = None
+
+    def _serve(self):
+        import select
+        buf = b''
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            buf += data
+            if TERMINATOR not in buf:
+                continue
+            # Reply to all the complete commands at once, like the
+            # chopper draining its input buffer
+            *commands, buf = buf.split(TERMINATOR)
+            reply = b''
+            for command in commands:
+                command = command.decode(ENCODING).strip()
+                if command:
+                    reply += self.execute(command)
+            if self.latency:
+                time.sleep(self.latency)
+            os.write(self._master, reply)
+            self.writes += 1
+
+    def execute(self, command):
+        """Reply (echo, value and prompt) to one command"""
+        self.counts[command] += 1
+        names = {c: n for n, c in SETTINGS.items()}
+        readings = {c: n for n, c in READINGS.items()}
+        value = None
+        if command.endswith('?'):
+            key = command[:-1]
+            if key in names:
+                value = self.settings[names[key]]
+            elif key in readings:
+                value = self.reading(readings[key])
+            else:
+                value = 'CMD_NOT_DEFINED'
+        elif '=' in command:
+            key, arg = command.split('=', 1)
+            if key not in names:
+                value = 'CMD_NOT_DEFINED'
+            else:
+                try:
+                    self.settings[names[key]] = int(arg)
+                except ValueError:
+                    value = 'CMD_ARG_INVALID'
+        elif command == 'restore':
+            self.settings = dict(DEFAULT_SETTINGS)
+        else:
+            value = 'CMD_NOT_DEFINED'
+
+        reply = command.encode(ENCODING) + TERMINATOR
+        if value is not None:
+            reply += str(value).encode(ENCODING) + TERMINATOR
+        return reply + PROMPT
+
+    def reading(self, name):
+        if name == 'locked':
+            return self.locked
+        if name == 'reference_frequency':
+            return self.reference_frequency
+        if not self.settings['enable']:     # output_frequency
+            return 0
+        if self.settings['reference']:
+            return (self.reference_frequency * self.settings['nharmonic']
+                    // self.settings['dharmonic'])
+        return self.settings['frequency']
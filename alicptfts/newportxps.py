@@ -1,50 +1,526 @@
 # Part of the code is adapated from Matthew Newville's package
 # https://github.com/pyepics/newportxps 
 
+import hashlib
+import json
 import os
+import queue
+import tempfile
+import threading
 import time
 from collections import OrderedDict
 from configparser import ConfigParser
-from sftpwrapper import SFTPWrapper
-
-import sys
-sys.path.append(r'../lib')
-
-# Load Python.Net
-# CLR namespaces are recognized as Python packages
-import clr
-from System import String
-from System.Collections import *
-clr.AddReference('Newport.XPS.CommandInterface')
-from CommandInterfaceXPS import *
+from . import backends
+from .gathering import read_gathering
+from .xpsclient import MOTION_COMMANDS
 
 import numpy as np
 
+# Location of Newport.XPS.CommandInterface.dll for the clr backend
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib')
+SCAN_MODES = ('legs', 'pvt', 'tcl')
+
+# Trajectory elements sent per MultipleAxesPVTLoadToMemory command
+PVT_LINES_PER_COMMAND = 20
+
+# Gathered velocities within this fraction of the cruise velocity are
+# counted as cruising in the duty cycle of a PVT scan
+CRUISE_TOLERANCE = 0.01
+
+# Group states with a motion in progress: homing, moving, trajectory
+# and jogging (XPS Programming Manual Sec. 8.8)
+MOTION_STATES = (43, 44, 45, 47)
+
+# States that GroupMoveAbort does not change: homing and referencing
+UNABORTABLE_STATES = (43, 64)
+
+# READY and DISABLE states, only reached by a referenced (homed) group
+READY_STATES = range(10, 19)
+DISABLE_STATES = range(20, 37)
+
+# Root of the controller file system as seen by TCL scripts
+XPS_HOME = '/Admin'
+
+# Controller-side scan of scan(mode='tcl'): script in Public/Scripts,
+# task name and the file of timestamps written by the script in Public
+TCL_SCAN_SCRIPT = 'alicptfts_scan.tcl'
+TCL_SCAN_TASK = 'alicptfts_scan'
+TCL_STAMPS_FILE = 'SCAN_STAMPS.DAT'
+
+TCL_SCAN_HEADER = """# Back-and-forth scan generated by alicptfts
+# Argument: run identifier, written as the first line of $StampsFile
+set RunID [lindex $tcl_argv 0]
+set Stamps {}
+set code [catch "OpenConnection 60 SocketID"]
+if {$code != 0} {
+    exit
+}
+
+proc Save {lines} {
+    global RunID StampsFile
+    set f [open $StampsFile w]
+    puts $f $RunID
+    foreach line $lines {
+        puts $f $line
+    }
+    close $f
+}
+
+proc Call {command args} {
+    global SocketID
+    set code [catch "$command $SocketID $args"]
+    if {$code != 0} {
+        Save [list "Error: $command failed ($code)"]
+        TCP_CloseSocket $SocketID
+        exit
+    }
+}
+
+proc Stamp {} {
+    global SocketID Stamps
+    catch "ElapsedTimeGet $SocketID Elapsed"
+    lappend Stamps $Elapsed
+}
+"""
+
+# Default directory of the cached system.ini parse (see read_systemini)
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.alicptfts')
+
+# Controller files the cached groups and stages depend on
+CONFIG_FILES = ('system.ini', 'stages.ini')
+
 class XPSException(Exception):
     pass
 
+def _clr_xps():
+    """Create the XPS object of Newport's .NET assembly"""
+    # Load Python.Net
+    # CLR namespaces are recognized as Python packages
+    import clr
+    clr.AddReference(os.path.join(LIB_DIR, 'Newport.XPS.CommandInterface'))
+    from CommandInterfaceXPS import XPS
+    return XPS()
+
+class XPSPool:
+    """Logged-in sockets to one XPS controller
+
+    Commands that only return once a motion is over (MOTION_COMMANDS)
+    get a dedicated socket per group, opened on first use.  All other
+    commands go to the least busy of nb_query query sockets, so that
+    status queries are not held up by a running move.  One more socket
+    is reserved for aborting motions.  Attribute access mirrors the XPS
+    object of the backend.
+    """
+    def __init__(self, new_xps, nb_query=2):
+        self._new_xps = new_xps
+        self.nb_query = nb_query
+        self.host = None
+        self.port = None
+        self.timeout = None
+        self.username = None
+        self.password = None
+        self._query = []            # query sockets
+        self._busy = []             # commands in progress per query socket
+        self._motion = {}           # {group : motion socket}
+        self._abort = None          # reserved for GroupMoveAbort
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _login(self):
+        xps = self._new_xps()
+        op = xps.OpenInstrument(self.host, self.port, self.timeout)
+        if op != 0:
+            raise XPSException('Error: Could not open XPS')
+        res, err = xps.Login(self.username, self.password, '')
+        if res != 0:
+            xps.CloseInstrument()
+            raise XPSException(err)
+        return xps
+
+    def open(self, host, port, timeout, username, password):
+        """Open and log in the query sockets and the abort socket
+
+        The sockets of a previous open are closed first.
+        """
+        self.CloseInstrument()
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.username = username
+        self.password = password
+        sockets = []
+        try:
+            for _ in range(self.nb_query + 1):
+                sockets.append(self._login())
+        except XPSException:
+            for xps in sockets:
+                xps.CloseInstrument()
+            raise
+        abort = sockets.pop()
+        with self._lock:
+            self._query = sockets
+            self._busy = [0] * len(sockets)
+            self._abort = abort
+            self._next = 0
+
+    def abort_socket(self):
+        """Return the socket reserved for aborting motions"""
+        with self._lock:
+            xps = self._abort
+        if xps is None:
+            xps = self._login()
+            with self._lock:
+                self._abort = xps
+        return xps
+
+    def motion_socket(self, group):
+        """Return the socket reserved for the motions of a group"""
+        with self._lock:
+            xps = self._motion.get(group)
+        if xps is None:
+            xps = self._login()
+            with self._lock:
+                xps, extra = self._motion.setdefault(group, xps), xps
+            if extra is not xps:
+                extra.CloseInstrument()
+        return xps
+
+    def _acquire(self):
+        with self._lock:
+            if not self._query:
+                raise XPSException('Error: XPS sockets are not open')
+            n = len(self._query)
+            # Least busy socket, round robin among equals
+            i = min(range(n), key=lambda k: (self._busy[k], (k - self._next) % n))
+            self._next = (i + 1) % n
+            self._busy[i] += 1
+        return i
+
+    def _release(self, i):
+        with self._lock:
+            self._busy[i] -= 1
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not self._query:
+            raise AttributeError(name)
+        getattr(self._query[0], name)       # AttributeError if not a command
+
+        if name in MOTION_COMMANDS:
+            def method(group, *args):
+                return getattr(self.motion_socket(group), name)(group, *args)
+        else:
+            def method(*args):
+                i = self._acquire()
+                try:
+                    return getattr(self._query[i], name)(*args)
+                finally:
+                    self._release(i)
+        method.__name__ = name
+        return method
+
+    def CloseAllOtherSockets(self, errstring=''):
+        """Close all other sockets, including the rest of the pool"""
+        with self._lock:
+            keep = self._query[0]
+            others = self._query[1:] + list(self._motion.values()) + [self._abort]
+            self._query, self._busy, self._motion = [keep], [0], {}
+            self._abort = None
+        ret = keep.CloseAllOtherSockets(errstring)
+        for xps in others:
+            if xps is not None:
+                xps.CloseInstrument()
+        return ret
+
+    def CloseInstrument(self):
+        with self._lock:
+            sockets = self._query + list(self._motion.values()) + [self._abort]
+            self._query, self._busy, self._motion = [], [], {}
+            self._abort = None
+        res = 0
+        for xps in sockets:
+            if xps is None:
+                continue
+            if xps.CloseInstrument() != 0:
+                res = -1
+        return res
+
+def parse_gathering_lines(text, ncols):
+    """Convert the text of GatheringDataMultipleLinesGet into an array
+
+    Lines are separated by newlines and values by semicolons. Returns
+    an array of shape (nb_lines, ncols).
+    """
+    values = text.strip().replace('\n', ';').split(';')
+    if '' in values:
+        values = [v for v in values if v]
+    return np.array(values, dtype=float).reshape(-1, ncols)
+
+def pvt_trajectory(minus, plus, velocity, acceleration, nb_sweeps):
+    """Back-and-forth PVT trajectory between minus and plus
+
+    The trajectory starts and ends at rest at minus. The sweeps at
+    constant velocity are joined by turnarounds at constant
+    acceleration, each made of two elements (decelerate to rest at
+    the end of the range, accelerate back), so that the stage never
+    stops in between.
+
+    Returns
+    -------
+    elements : list of (dt, dx, v_end)
+        Duration, displacement and final velocity of each element, as
+        in an XPS PVT trajectory file.
+
+    cruise_time : float
+        Time at constant velocity of each sweep.
+    """
+    d_turn = velocity**2 / (2 * acceleration)
+    t_turn = velocity / acceleration
+    cruise = (plus - minus) - 2 * d_turn
+    if cruise <= 0:
+        raise ValueError('Error: Scan range is too short for the velocity and acceleration')
+    cruise_time = cruise / velocity
+
+    direction = 1.
+    elements = [(t_turn, d_turn, velocity)]                 # accelerate from minus
+    for i in range(nb_sweeps):
+        elements.append((cruise_time, direction * cruise, direction * velocity))
+        elements.append((t_turn, direction * d_turn, 0.))   # decelerate to the end
+        if i < nb_sweeps - 1:
+            direction = -direction
+            elements.append((t_turn, direction * d_turn, direction * velocity))
+    return elements, cruise_time
+
+def tcl_scan_script(group, minus, plus, origin, repeat, gathering_params, stamps_file):
+    """TCL script of a back-and-forth scan run by the controller
+
+    The script starts the gathering, makes the same moves as
+    NewportXPS._scan_legs with an ElapsedTimeGet stamp at the same
+    points, saves the gathering and writes the 2*repeat + 4 stamps
+    to stamps_file (a path on the controller). If a command fails,
+    the file holds the error message instead of the stamps.
+    """
+    lines = ['set StampsFile {0}'.format(stamps_file), TCL_SCAN_HEADER]
+
+    def move(target):
+        lines.append('Call GroupMoveAbsolute {0} {1:.6f}'.format(group, target))
+
+    lines.append('Stamp')
+    lines.append('Call GatheringRun {0:d} {1:d}'.format(int(gathering_params[0]),
+                                                      int(gathering_params[1])))
+    move(plus)
+    for i in range(repeat):
+        lines.append('Stamp')
+        move(minus)
+        lines.append('Stamp')
+        move(plus)
+    lines.append('Stamp')
+    move(minus)
+    lines.append('Stamp')
+    move(origin)
+    lines.append('Stamp')
+    lines.append('Call GatheringStopAndSave')
+    lines.append('Save $Stamps')
+    lines.append('TCP_CloseSocket $SocketID')
+    return '\n'.join(lines) + '\n'
+
+class LegDetector:
+    """Find the legs of a motion in blocks of gathered setpoint positions
+
+    A leg is a run of samples over which the setpoint moves in one
+    direction. Its boundaries are gathering sample indices, exact to
+    the gathering period (divisor servo cycles) and free of any host
+    clock: the last sample at rest (or at the turnaround) before the
+    leg and the first one after it.
+    """
+    def __init__(self):
+        self.count = 0              # number of samples fed
+        self.legs = []              # [(start, end)] of the finished legs
+        self._last = None
+        self._sign = 0.
+        self._start = 0
+
+    def feed(self, setpoint):
+        """Process the next block of setpoint positions"""
+        setpoint = np.asarray(setpoint, dtype=float)
+        if len(setpoint) == 0:
+            return
+        if self._last is None:
+            values, offset = setpoint, 0
+        else:
+            values, offset = np.concatenate([[self._last], setpoint]), self.count - 1
+
+        # sign[k] is the direction from sample offset+k to offset+k+1
+        sign = np.sign(np.diff(values))
+        changes = np.flatnonzero(np.diff(np.concatenate([[self._sign], sign])))
+        for k in changes:
+            if self._sign != 0:
+                self.legs.append((self._start, offset + k))
+            self._sign = sign[k]
+            self._start = offset + k
+
+        self._last = setpoint[-1]
+        self.count += len(setpoint)
+
+    def finish(self):
+        """Return the legs as an integer array of shape (nb_legs, 2)"""
+        legs = list(self.legs)
+        if self._sign != 0:             # still moving at the last sample
+            legs.append((self._start, self.count - 1))
+        return np.array(legs, dtype=int).reshape(-1, 2)
+
+class GatheringStream:
+    """Download the gathering buffer while data are being gathered
+
+    A background thread polls GatheringCurrentNumberGet on a query
+    socket and reads the new lines with pipelined
+    GatheringDataMultipleLinesGet requests. Every block of new lines
+    is passed to callback as an (n, ncols) array, or, without a
+    callback, can be consumed by iterating over the stream.
+    """
+    def __init__(self, newportxps, ncols, callback=None,
+                 interval=0.05, lines_per_request=1000):
+        self.newportxps = newportxps
+        self.ncols = ncols
+        self.callback = callback
+        self.interval = interval
+        self.lines_per_request = lines_per_request
+        self.count = 0              # number of lines downloaded
+        self._blocks = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='gathering', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Download the remaining lines and wait for the thread
+
+        Call after GatheringStop so that the last lines are included.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __iter__(self):
+        while True:
+            block = self._blocks.get()
+            if block is None:
+                return
+            yield block
+
+    def _run(self):
+        try:
+            while True:
+                stopping = self._stop.is_set()  # poll once more after stop()
+                self.poll()
+                if stopping:
+                    break
+                self._stop.wait(self.interval)
+        except Exception as exc:
+            self._error = exc
+        finally:
+            self._blocks.put(None)
+
+    def poll(self):
+        """Download the lines gathered since the last call"""
+        xps = self.newportxps
+        res, current, maximum, err = xps._xps.GatheringCurrentNumberGet(0, 0, '')
+        try:
+            xps.check_error(res, err)
+        except XPSException:
+            raise
+        if current <= self.count:
+            return
+
+        calls = []
+        for start in range(self.count, current, self.lines_per_request):
+            nb_lines = min(self.lines_per_request, current - start)
+            calls.append(('GatheringDataMultipleLinesGet', (start, nb_lines, '', '')))
+        for res, text, err in xps.batch(calls):
+            try:
+                xps.check_error(res, err)
+            except XPSException:
+                raise
+            block = parse_gathering_lines(text, self.ncols)
+            self.count += len(block)
+            if self.callback is not None:
+                self.callback(block)
+            else:
+                self._blocks.put(block)
+
 class NewportXPS:
     def __init__(self, host, port=5001, timeout=1000,
                  username='Administrator',
-                 password='Administrator'):
+                 password='Administrator',
+                 backend='native',
+                 ftpconn=None,
+                 group_names=None,
+                 nb_sockets=2,
+                 cache_dir=CACHE_DIR,
+                 warm=False):
+        """Connect to the XPS controller and initialize the groups
+
+        Parameters
+        ----------
+        backend : string
+            Implementation of the XPS command interface. 'native'
+            (default) speaks the TCP protocol directly from Python;
+            'clr' uses Newport.XPS.CommandInterface.dll through
+            Python.NET. Other backends can be registered with
+            backends.register('xps', ...).
+
+        ftpconn : SFTPWrapper, optional
+            File transfer object for the controller (default is a
+            new SFTPWrapper), e.g. the file store of XPSSimulator.
+            The session stays open between transfers until close().
+
+        group_names : dict, optional
+            XPS group names of 'PointingLinear', 'PointingRotary' and
+            'MovingLinear' if they differ from these names in system.ini.
+
+        nb_sockets : int
+            Number of sockets for queries (default is 2). Each group
+            also gets its own socket for motion commands.
+
+        cache_dir : string, optional
+            Directory of the cached groups and stages (default is
+            ~/.alicptfts); None disables the cache.
+
+        warm : bool
+            If True, only re-home the groups that are not referenced
+            (see initialize; default is False).
+        """
         self.host = host                # IP address
         self.port = port
         self.timeout = timeout
         self.username = username
         self.password = password
+        self.backend = backend
 
         self.ftphome = ''
-        self.ftpconn = None
+        self.ftpconn = ftpconn
         self.ftpargs = dict(host=self.host,
                             username=self.username,
                             password=self.password)
         
-        self._xps = XPS()
+        self._xps = XPSPool(self._new_xps, nb_query=nb_sockets)
         self.firmware_ver = None
         self.stages = OrderedDict()    
         self.groups = OrderedDict()     # {'PointingLinear' : {GroupInfo},
                                         #  'PointingRotary' : {GroupInfo},
                                         #  'MovingLinear'   : {GroupInfo}}
+        self.group_names = dict(group_names or {})
+        self.cache_dir = cache_dir
+        self.gathering_types = []       # configured by scan()
+        self.scan_report = None         # duty cycle of the last PVT scan
+        self.killed_groups = []         # groups killed by the last stop_all()
+        self.leg_indices = None         # legs of the last scan in gathering samples
+        self.init_report = None         # per-group outcome of initialize()
+        self.scan_info = None           # arguments and settings of the last scan
 
         # Connect the controller and stages
         try:
@@ -52,30 +528,26 @@ class NewportXPS:
         except Exception:
             raise
         try:
-            self.initialize()
+            self.initialize(warm=warm)
         except Exception:
             raise
 
+    def _new_xps(self):
+        """Create an XPS command interface for the selected backend"""
+        return backends.create('xps', self.backend)
+
     def connect(self, new_socket=True):
         """Connect to the XPS and read system.ini"""
         # Establish connection with XPS
         if new_socket:
-            op = self._xps.OpenInstrument(self.host,
-                                        self.port,
-                                        self.timeout)
             try:
-                self.check_error(op, 'Error: Could not open XPS')
+                self._xps.open(self.host, self.port, self.timeout,
+                               self.username, self.password)
             except XPSException:
                 raise
             else:
                 print('Open {0} : {1}'.format(self.host, self.port))
 
-            log, err_log = self._xps.Login(self.username, self.password, '')
-            try:
-                self.check_error(log, err_log)
-            except XPSException:
-                raise
-
             res, ver, err_firmware = self._xps.FirmwareVersionGet('', '')
                                             # TODO: or InstallerVersionGet?
             try:
@@ -86,7 +558,9 @@ class NewportXPS:
             self.firmware_ver = ver
         
         # Read group info from system.ini through SFTP
-        self.ftpconn = SFTPWrapper()
+        if self.ftpconn is None:
+            from .sftpwrapper import SFTPWrapper     # pysftp only when needed
+            self.ftpconn = SFTPWrapper()
         try:
             self.read_systemini()
         except Exception:
@@ -97,6 +571,15 @@ class NewportXPS:
         """Get group info from the system.ini file
         
         Parse info to self.groups and self.stages
+
+        The result is cached in self.cache_dir with the firmware
+        version, the size and time of system.ini and stages.ini and a
+        hash of their content. While the sizes and times match, the
+        files are neither downloaded nor parsed and the stages are not
+        queried. If they changed but the content did not, the files
+        are downloaded but not parsed. Travel limits changed with
+        PositionerUserTravelLimitsSet since the cache was written are
+        not seen; call clear_cache() after such changes.
         """
         try:
             self.ftpconn.connect(**self.ftpargs)
@@ -106,13 +589,30 @@ class NewportXPS:
             self.ftpconn.cwd(os.path.join(self.ftphome, 'Config'))
         except IOError:
             raise
+
+        cache = self._load_cache()
+        stats = [self._config_stat(fname) for fname in CONFIG_FILES]
+        if cache is not None and cache['stats'] == stats:
+            self._restore_cache(cache)
+            return
+
         try:
             lines = self.ftpconn.getlines('system.ini')
         except Exception:
             raise
-        self.ftpconn.close()
+        digest = hashlib.sha1('\n'.join(lines).encode('latin-1'))
+        if stats[1] is not None:
+            try:
+                digest.update('\n'.join(self.ftpconn.getlines('stages.ini')).encode('latin-1'))
+            except Exception:
+                raise
+        digest = digest.hexdigest()
+        if cache is not None and cache['digest'] == digest:
+            self._restore_cache(cache)
+            self._save_cache(stats, digest)
+            return
 
-        # Rarse system.ini just read in
+        # Parse system.ini just read in
         conf = ConfigParser()
         try:
             conf.read_string('\n'.join(lines))
@@ -121,6 +621,8 @@ class NewportXPS:
             raise
 
         # Register the group info
+        self.groups.clear()
+        self.stages.clear()
         for gtype, glist in conf.items('GROUPS'):
             if len(glist) > 0:
                 for gname in glist.split(','):
@@ -140,10 +642,16 @@ class NewportXPS:
             elif 'plugnumber' in items:     # a stage
                 self.stages[section] = {'stagetype': conf.get(section, 'stagename')}
         
+        # Query all stages in one pipelined exchange
+        calls = []
         for sname in self.stages:
-            r_vel_acc, vel, acc, err_vel_acc = self._xps.PositionerMaximumVelocityAndAccelerationGet(sname, 
-                                                                                                     0, 0,
-                                                                                                     '')
+            calls.append(('PositionerMaximumVelocityAndAccelerationGet', (sname, 0, 0, '')))
+            ## Travel limits can be set by PositionerUserTravelLimitsSet
+            calls.append(('PositionerUserTravelLimitsGet', (sname, 0, 0, '')))
+        replies = self.batch(calls)
+
+        for i, sname in enumerate(self.stages):
+            r_vel_acc, vel, acc, err_vel_acc = replies[2*i]
             try:
                 self.check_error(r_vel_acc, err_vel_acc)
             except XPSException:
@@ -156,10 +664,7 @@ class NewportXPS:
                 print('Error: Could not set max velocity/accleration for {0}'.format(sname))
                 raise
 
-            ## Travel limits can be set by PositionerUserTravelLimitsSet
-            r_lim, min_target, max_target, err_lim = self._xps.PositionerUserTravelLimitsGet(sname,
-                                                                                             0, 0,
-                                                                                             '')
+            r_lim, min_target, max_target, err_lim = replies[2*i+1]
             try:
                 self.check_error(r_lim, err_lim)
             except Exception:
@@ -172,29 +677,202 @@ class NewportXPS:
                 print('Error: Could not set travel limit for {0}'.format(sname))
                 raise
 
-    def initialize(self):
+        self._save_cache(stats, digest)
+
+    ## Cache of read_systemini
+    def _cache_file(self):
+        return os.path.join(self.cache_dir, 'xps_{0}_{1}.json'.format(self.host, self.port))
+
+    def _config_stat(self, fname):
+        """[size, mtime] of a file in Config, None if it does not exist"""
+        try:
+            return list(self.ftpconn.stat(fname))
+        except IOError:
+            return None
+
+    def _load_cache(self):
+        """Return the cache entry of this controller and firmware, or None"""
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._cache_file()) as f:
+                cache = json.load(f, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            return None
+        if cache.get('firmware') != self.firmware_ver:
+            return None
+        return cache
+
+    def _restore_cache(self, cache):
+        self.groups.clear()
+        self.groups.update(cache['groups'])
+        self.stages.clear()
+        self.stages.update(cache['stages'])
+
+    def _save_cache(self, stats, digest):
+        if self.cache_dir is None:
+            return
+        cache = OrderedDict(firmware=self.firmware_ver, stats=stats, digest=digest,
+                            groups=self.groups, stages=self.stages)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, fname = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f, indent=1)
+            os.replace(fname, self._cache_file())
+        except (IOError, OSError):
+            print('Error: Could not write the cache of system.ini in {0}'.format(self.cache_dir))
+
+    def clear_cache(self):
+        """Forget the cached groups and stages of this controller"""
+        if self.cache_dir is None:
+            return
+        try:
+            os.remove(self._cache_file())
+        except OSError:
+            pass
+
+    def initialize(self, progress=None, warm=False, grp_names=None):
         """Establish the motion groups and optionally home the stages
         
         Currently implementation assumes three SingleAxisGroups
         in self._groups
+
+        The groups are killed, initialized and homed concurrently, one
+        thread per group on its own motion socket, so that the time is
+        that of the slowest stage. self.init_report then holds, per
+        group, the action taken and why, the last step reached, the
+        final status, the time taken and the error if any.
+
+        Parameters
+        ----------
+        progress : callable, optional
+            Called as progress(group, step) when a group starts the
+            step 'kill', 'initialize', 'home' or 'enable', and with
+            'done' at the end.
+
+        warm : bool
+            If True, the statuses of the groups are read in one batch
+            first and only the groups that are not referenced are
+            re-homed: groups in a READY state are left as they are and
+            groups in a DISABLE state are only enabled (default is
+            False, re-home all groups).
+
+        grp_names : list of string, optional
+            Groups to initialize (default is all groups).
         """
-        for g in self.groups:
+        if grp_names is None:
+            grp_names = list(self.groups)
+        groups = [self.get_group(g) for g in grp_names]
+
+        plan = OrderedDict((g, ('home', 'cold initialize')) for g in groups)
+        if warm:
             try:
-                self.kill_group(group=g)
-            except Exception:
-                print('Error: Could not kill group {0} during initialization'.format(g))
+                plan = self._warm_plan(groups)
+            except XPSException:
                 raise
 
-        for g in self.groups:
+        self.init_report = OrderedDict()
+        for g in groups:
+            action, reason = plan[g]
+            self.init_report[g] = OrderedDict(action=action, reason=reason, step=None,
+                                              status=None, seconds=None, error=None)
+
+        steps = {'home': (('kill', self.kill_group),
+                          ('initialize', self._initialize_only),
+                          ('home', self.home_group)),
+                 'enable': (('enable', self.enable_group),),
+                 'none': ()}
+
+        def init_group(g):
+            report = self.init_report[g]
+            t_start = time.perf_counter()
+            for step, action in steps[report['action']]:
+                report['step'] = step
+                if progress is not None:
+                    progress(g, step)
+                action(g)
+            report['seconds'] = time.perf_counter() - t_start
+            report['status'] = self.get_group_status(g)
+            if progress is not None:
+                progress(g, 'done')
+
+        errors = self.run_groups(init_group, groups)
+        for g, exc in errors.items():
+            if exc is not None:
+                self.init_report[g]['error'] = str(exc)
+        for g, report in self.init_report.items():
+            if report['error'] is None:
+                print('{0}: {1} ({2}), status {3} after {4:.2f} s'.format(
+                      g, report['action'], report['reason'], report['status'], report['seconds']))
+            else:
+                print('Error: Could not {0} group {1}: {2}'.format(report['step'], g, report['error']))
+        for exc in errors.values():
+            if exc is not None:
+                raise exc
+
+    def _warm_plan(self, groups):
+        """Decide from the group statuses which groups need homing
+
+        Returns
+        -------
+        dict of {group : (action, reason)}, action being 'none',
+        'enable' or 'home'
+        """
+        replies = self.batch([('GroupStatusGet', (g, 0, '')) for g in groups])
+        for res, status, err in replies:
             try:
-                self.initialize_group(group=g, with_encoder=True, homing=True)
-            except Exception:
-                print('Error: Could not initialize group {0}'.format(g))
+                self.check_error(res, err)
+            except XPSException:
+                print('Error: Unable to check the group status')
                 raise
+        codes = [status for _, status, _ in replies]
+        descriptions = self.batch([('GroupStatusStringGet', (c, '', '')) for c in codes])
+
+        plan = OrderedDict()
+        for g, code, (res, text, err) in zip(groups, codes, descriptions):
+            state = '{0}: {1}'.format(code, text if res == 0 else 'unknown status')
+            if code in READY_STATES:
+                plan[g] = ('none', 'already referenced, ' + state)
+            elif code in DISABLE_STATES:
+                plan[g] = ('enable', 'referenced but disabled, ' + state)
+            else:
+                plan[g] = ('home', 'not referenced, ' + state)
+        return plan
 
-    def configure_pointing(self, positions, relative):
+    def _initialize_only(self, grp_name):
+        self.initialize_group(grp_name, with_encoder=True, homing=False)
+
+    def run_groups(self, func, grp_names):
+        """Run func(grp_name) for every group at once, in one thread each
+
+        Motion commands of different groups go to different sockets
+        (see XPSPool), so that the groups move concurrently.
+
+        Returns
+        -------
+        dict of {grp_name : exception raised by func, or None}
+        """
+        errors = OrderedDict((g, None) for g in grp_names)
+
+        def target(g):
+            try:
+                func(g)
+            except Exception as exc:
+                errors[g] = exc
+        threads = [threading.Thread(target=target, args=(g,), name=g, daemon=True)
+                   for g in grp_names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def configure_pointing(self, positions, relative, check=False, tolerance=1e-3):
         """Configure the pointing mirror
         
+        Both axes are moved at the same time (see run_groups).
+
         Parameters
         ----------
         positions : array of float
@@ -203,6 +881,15 @@ class NewportXPS:
         relative : bool
             If relative is True, the pointing mirror is configured to the
             original coordinates plus "positions".
+
+        check : bool
+            If True, check after the moves that both groups are READY
+            and that their current positions are within tolerance of
+            the setpoints (default is False).
+
+        tolerance : float
+            Maximum distance between current and setpoint positions in
+            the units of the stages (default is 1e-3).
         """
         try:
             pos, ang = positions[0], positions[1]
@@ -210,17 +897,50 @@ class NewportXPS:
             print('Error: Could not set the position and angle')
             raise
 
-        try:
-            self.move_group('PointingLinear', pos, 1, relative, True)
-        except Exception:
-            raise
+        targets = OrderedDict([('PointingLinear', pos), ('PointingRotary', ang)])
+        errors = self.run_groups(lambda g: self.move_group(g, targets[g], 1, relative, False),
+                                 list(targets))
+        for exc in errors.values():
+            if exc is not None:
+                raise exc
 
-        try:
-            self.move_group('PointingRotary', ang, 1, relative, True)
-        except Exception:
-            raise
+        if check:
+            try:
+                self.check_at_position(list(targets), tolerance)
+            except XPSException:
+                raise
+
+    def check_at_position(self, grp_names, tolerance=1e-3):
+        """Check that groups are READY at their setpoint positions
 
-    def scan(self, scan_range, repeat, gathering_params=(100000, 8)):
+        The statuses and positions are read in one batch. Raises
+        XPSException if a group is not READY or if its current
+        position is farther than tolerance from its setpoint.
+        """
+        groups = [self.get_group(g) for g in grp_names]
+        calls = []
+        for g in groups:
+            calls.append(('GroupStatusGet', (g, 0, '')))
+            calls.append(('GroupPositionCurrentGet', (g, [0.0], 1, '')))
+            calls.append(('GroupPositionSetpointGet', (g, [0.0], 1, '')))
+        replies = self.batch(calls)
+
+        for i, g in enumerate(groups):
+            (r_status, status, err_status), (r_cur, current, err_cur), (r_set, setpoint, err_set) = \
+                replies[3*i:3*i+3]
+            for res, err in ((r_status, err_status), (r_cur, err_cur), (r_set, err_set)):
+                try:
+                    self.check_error(res, err)
+                except XPSException:
+                    raise
+            if status not in READY_STATES:
+                raise XPSException('Error: Group {0} is not READY after the move (status {1})'.format(g, status))
+            if abs(current[0] - setpoint[0]) > tolerance:
+                raise XPSException('Error: Group {0} is at {1:.6f} instead of {2:.6f}'.format(
+                                   g, current[0], setpoint[0]))
+
+    def scan(self, scan_range, repeat, gathering_params=(100000, 8), callback=None,
+             mode='legs', extra_types=()):
         """Perform a scan with data gathering
         
         Parameters
@@ -232,7 +952,35 @@ class NewportXPS:
 
         repeat : int
             Number of full back-and-forth scans (default is 15).
+
+        callback : callable, optional
+            If given, the gathering data are passed to callback while
+            the stage moves, as blocks of shape (n, 4) (position,
+            velocity, acceleration, setpoint position); see
+            GatheringStream.
+
+        mode : string
+            'legs' (default) moves MovingLinear with one GroupMoveAbsolute
+            per leg. 'pvt' runs all the sweeps as one PVT trajectory with
+            smooth turnarounds (MovingLinear must then be a MultipleAxes
+            group); the duty cycle is reported in self.scan_report.
+            'tcl' uploads the legs, the gathering and the timestamps as
+            a TCL script run by the controller, free of network jitter;
+            the timestamps are then controller times (ElapsedTimeGet).
+
+        extra_types : list of string
+            Gathering types appended to the four above, e.g. the
+            detector signal 'GPIO2.ADC1'. They are passed to callback
+            as the next columns of the blocks.
+
+        Returns
+        -------
+        Host timestamps of the legs (see _scan_legs). The leg boundaries
+        found in the gathered setpoint position are kept in
+        self.leg_indices as gathering sample indices (see LegDetector).
         """
+        if mode not in SCAN_MODES:
+            raise ValueError('Error: Unknown scan mode {0}, use one of {1}'.format(mode, SCAN_MODES))
         try:
             positioner = self.get_positioner('MovingLinear')    # group and axis in string
         except Exception:
@@ -258,11 +1006,11 @@ class NewportXPS:
             status = self.get_group_status('MovingLinear')
         except Exception:
             raise
-        # Ready state from homing; see XPS Programming
-        # Manual Sec. 8.8
-        if status != 11:
+        # Any READY state follows a homing, e.g. 12 after the moves of
+        # a previous scan; see XPS Programming Manual Sec. 8.8
+        if status not in READY_STATES:
             try:
-                self.home_group('MovingLinear')
+                self.initialize(warm=True, grp_names=['MovingLinear'])
             except Exception:
                 raise
         try:
@@ -270,28 +1018,303 @@ class NewportXPS:
         except Exception:
             print('Error: Unable to get the origin')
             raise
+        try:
+            self.scan_info = self._scan_info(mode, minus, plus, origin, repeat, gathering_params)
+        except Exception:
+            raise
+
+        if mode == 'pvt':
+            try:
+                elements, cruise_time = self.load_pvt_scan(minus, plus, repeat)
+            except Exception:
+                print('Error: Could not load the PVT trajectory')
+                raise
+            try:
+                self.move_group('MovingLinear', minus, 1, False, False)   # Start of the trajectory
+            except Exception:
+                raise
+
+        if mode == 'tcl':
+            try:
+                self.upload_tcl_scan(minus, plus, origin, repeat, gathering_params)
+            except Exception:
+                print('Error: Could not upload the TCL scan script')
+                raise
 
         # Begin scaning and data gathering
         timestamps = np.zeros(2*repeat + 4)
-        res_confg, err_confg = self._xps.GatheringConfigurationSet(positioner+'.CurrentPosition', 
-                                                                   positioner+'.CurrentVelocity',
-                                                                   positioner+'.CurrentAcceleration',
-                                                                   '')
+        self.gathering_types = [positioner+'.CurrentPosition',
+                                positioner+'.CurrentVelocity',
+                                positioner+'.CurrentAcceleration',
+                                positioner+'.SetpointPosition'] + list(extra_types)
+        res_confg, err_confg = self._xps.GatheringConfigurationSet(self.gathering_types, '')
         try:
             self.check_error(res_confg, err_confg)
         except XPSException:
             raise
 
-        timestamps[0] = time.time()                             # First timestamp
+        if mode != 'tcl':                                       # the TCL script runs the gathering
+            timestamps[0] = time.time()                         # First timestamp
                                                                 # beginning of the scan
-        res_run, err_run = self._xps.GatheringRun(gathering_params[0], gathering_params[1], '')
+            res_run, err_run = self._xps.GatheringRun(gathering_params[0], gathering_params[1], '')
                                                   # num of data sets & time interval in servo cycles
                                                   # TODO: find the right/appropriate numbers
+            try:
+                self.check_error(res_run, err_run)
+            except XPSException:
+                raise
+        
+        # The gathering data are always streamed to find the legs
+        self.leg_indices = None
+        legs = LegDetector()
+        cruising = []               # |CurrentVelocity| at the cruise velocity, per sample
+        cruise_velocity = max(abs(e[2]) for e in elements) if mode == 'pvt' else None
+
+        def on_block(block):
+            legs.feed(block[:, 3])
+            if cruise_velocity is not None:
+                cruising.append(np.abs(np.abs(block[:, 1]) - cruise_velocity) <=
+                                CRUISE_TOLERANCE * cruise_velocity)
+            if callback is not None:
+                callback(block)
+        stream = GatheringStream(self, len(self.gathering_types), callback=on_block)
+        stream.start()
+
         try:
-            self.check_error(res_run, err_run)
+            if mode == 'pvt':
+                self._scan_pvt(elements, cruise_time, origin, timestamps)
+            elif mode == 'tcl':
+                self._scan_tcl(timestamps)
+            else:
+                self._scan_legs(minus, plus, origin, repeat, timestamps)
+        except Exception:
+            try:
+                stream.stop()
+            except Exception:
+                pass
+            finally:
+                try:
+                    self._xps.GatheringStop()   # also ends a gathering run by the TCL script
+                except Exception:
+                    pass
+            raise
+
+        if mode != 'tcl':
+            res_stop, err_stop = self._xps.GatheringStop()
+            try:
+                self.check_error(res_stop, err_stop)
+            except XPSException:
+                raise
+        try:
+            stream.stop()
+        except Exception:
+            print('Error: Could not download the gathering data')
+            raise
+        self.leg_indices = legs.finish()
+        if mode == 'pvt':
+            self._report_duty_cycle(cruising)
+        if mode != 'tcl':
+            res_save, err_save = self._xps.GatheringStopAndSave()
+            try:
+                self.check_error(res_save, err_save)
+            except XPSException:
+                raise
+
+        return timestamps
+
+    def _scan_info(self, mode, minus, plus, origin, repeat, gathering_params):
+        """Arguments of a scan with the SGamma parameters and pointing"""
+        try:
+            sgamma = self.get_motion_params('MovingLinear')
+        except Exception:
+            raise
+        pointing = OrderedDict()
+        for grp_name in ('PointingLinear', 'PointingRotary'):
+            try:
+                pointing[grp_name] = self.get_setpoint_position(grp_name, 1)[0]
+            except Exception:
+                pointing[grp_name] = None       # not in system.ini
+        return OrderedDict([('mode', mode),
+                            ('scan_range', [minus, plus]),
+                            ('repeat', repeat),
+                            ('origin', origin),
+                            ('gathering_params', list(gathering_params)),
+                            ('sgamma', OrderedDict(zip(['velocity', 'acceleration',
+                                                        'min_jerk_time', 'max_jerk_time'],
+                                                       sgamma))),
+                            ('pointing', pointing),
+                            ('start_time', time.time())])
+
+    def scan_metadata(self):
+        """Description of the controller and of the last scan
+
+        Returns
+        -------
+        dict (JSON serializable) with the firmware version, the groups
+        and stages read from system.ini, the gathering types and
+        self.scan_info.
+        """
+        return OrderedDict([('host', self.host),
+                            ('firmware', self.firmware_ver),
+                            ('groups', self.groups),
+                            ('stages', self.stages),
+                            ('gathering_types', list(self.gathering_types)),
+                            ('scan', self.scan_info)])
+
+    def load_pvt_scan(self, minus, plus, repeat):
+        """Generate the PVT trajectory of a scan, load it and verify it
+
+        The trajectory is loaded into the controller memory with
+        pipelined MultipleAxesPVTLoadToMemory commands (elements
+        separated by newlines) and checked by MultipleAxesPVTVerification.
+        It uses the current SGamma velocity and acceleration of
+        MovingLinear and starts from rest at minus.
+
+        Returns
+        -------
+        elements, cruise_time : see pvt_trajectory
+        """
+        try:
+            group = self.get_group('MovingLinear')
+            vel, acc = self.get_motion_params('MovingLinear')[:2]
+        except Exception:
+            raise
+        elements, cruise_time = pvt_trajectory(minus, plus, vel, acc, 2*repeat + 2)
+
+        lines = ['{0:.6f},{1:.6f},{2:.6f}'.format(*e) for e in elements]
+        calls = [('MultipleAxesPVTResetInMemory', (group, ''))]
+        for i in range(0, len(lines), PVT_LINES_PER_COMMAND):
+            part = '\n'.join(lines[i:i+PVT_LINES_PER_COMMAND])
+            calls.append(('MultipleAxesPVTLoadToMemory', (group, part, '')))
+        calls.append(('MultipleAxesPVTVerification', (group, 'FromMemory', '')))
+        for res, err in self.batch(calls):
+            try:
+                self.check_error(res, err)
+            except XPSException:
+                raise
+
+        return elements, cruise_time
+
+    def _scan_pvt(self, elements, cruise_time, origin, timestamps):
+        """All sweeps of MovingLinear in one MultipleAxesPVTExecution"""
+        try:
+            moving_linear = self.get_group('MovingLinear')
+        except Exception:
+            print('Error: Could not get group for the MovingLinear stage')
+            raise
+
+        t_exec = time.time()
+        res, err = self._xps.MultipleAxesPVTExecution(moving_linear, 'FromMemory', 1, '')
+        t_end = time.time()
+        try:
+            self.check_error(res, err)
         except XPSException:
             raise
-        
+
+        # Sweeps start at the turnarounds, where the velocity is zero
+        ends = t_exec + np.cumsum([e[0] for e in elements])
+        turnarounds = ends[[i for i, e in enumerate(elements) if e[2] == 0.]]
+        timestamps[1:len(turnarounds)] = turnarounds[:-1]
+        timestamps[-2] = t_end
+        try:
+            self.move_group(moving_linear, origin, 1, False, False)    # Back to the origin
+        except Exception:
+            raise
+        timestamps[-1] = time.time()
+
+        nb_sweeps = len(turnarounds)
+        trajectory_time = float(ends[-1] - t_exec)
+        self.scan_report = OrderedDict(mode='pvt',
+                                       nb_sweeps=nb_sweeps,
+                                       trajectory_time=trajectory_time,
+                                       execution_time=t_end - t_exec,
+                                       predicted_duty_cycle=nb_sweeps * cruise_time / trajectory_time,
+                                       achieved_duty_cycle=None)
+
+    def _report_duty_cycle(self, cruising):
+        """Measured duty cycle of a PVT scan from the gathered velocity
+
+        It is the fraction of the gathered samples inside the legs of
+        the trajectory (the first nb_sweeps of self.leg_indices, the
+        next one is the move back to the origin) at which
+        |CurrentVelocity| is within CRUISE_TOLERANCE of the cruise
+        velocity.
+
+        Parameters
+        ----------
+        cruising : list of array of bool
+            Samples at the cruise velocity, block by block.
+        """
+        at_cruise = np.concatenate(cruising) if cruising else np.zeros(0, dtype=bool)
+        inside = 0
+        total = 0
+        for start, end in self.leg_indices[:self.scan_report['nb_sweeps']]:
+            inside += int(at_cruise[start:end + 1].sum())
+            total += int(end + 1 - start)
+        achieved = float(inside) / total if total else float('nan')
+        self.scan_report['achieved_duty_cycle'] = achieved
+        print('PVT scan duty cycle: predicted {0:.1%}, achieved {1:.1%}'.format(
+              self.scan_report['predicted_duty_cycle'], achieved))
+
+    def upload_tcl_scan(self, minus, plus, origin, repeat, gathering_params):
+        """Generate the TCL script of a scan and upload it to Public/Scripts"""
+        try:
+            moving_linear = self.get_group('MovingLinear')
+        except Exception:
+            raise
+        stamps_file = '/'.join([XPS_HOME, 'Public', TCL_STAMPS_FILE])
+        script = tcl_scan_script(moving_linear, minus, plus, origin, repeat,
+                                 gathering_params, stamps_file)
+
+        fd, fname = tempfile.mkstemp(suffix='.tcl')
+        try:
+            with os.fdopen(fd, 'w', newline='\n') as f:
+                f.write(script)
+            self.upload_file(os.path.join('Public', 'Scripts'), TCL_SCAN_SCRIPT, fname)
+        finally:
+            os.remove(fname)
+
+    def _scan_tcl(self, timestamps, interval=0.05):
+        """Run the uploaded TCL scan and read its timestamps"""
+        run_id = '{0:d}'.format(int(time.time() * 1000))
+        res, err = self._xps.TCLScriptExecute(TCL_SCAN_SCRIPT, TCL_SCAN_TASK, run_id, '')
+        try:
+            self.check_error(res, err)
+        except XPSException:
+            raise
+
+        # Wait for the end of the task
+        try:
+            while True:
+                res, tasks, err = self._xps.TCLScriptRunningListGet('', '')
+                try:
+                    self.check_error(res, err)
+                except XPSException:
+                    raise
+                if TCL_SCAN_TASK not in [t.strip() for t in tasks.split(',')]:
+                    break
+                time.sleep(interval)
+        except BaseException:
+            self._xps.TCLScriptKill(TCL_SCAN_TASK, '')
+            raise
+
+        try:
+            lines = self.read_lines('Public', TCL_STAMPS_FILE)
+        except Exception:
+            print('Error: Could not read the timestamps of the TCL scan')
+            raise
+        lines = [l.strip() for l in lines if l.strip()]
+        if not lines or lines[0] != run_id:
+            raise XPSException('Error: TCL scan ended without writing its timestamps')
+        if len(lines) > 1 and lines[1].startswith('Error'):
+            raise XPSException(lines[1])
+        if len(lines) - 1 != len(timestamps):
+            raise XPSException('Error: Expected {0} timestamps from the TCL scan, got {1}'.format(
+                               len(timestamps), len(lines) - 1))
+        timestamps[:] = [float(l) for l in lines[1:]]
+
+    def _scan_legs(self, minus, plus, origin, repeat, timestamps):
+        """Back-and-forth moves of MovingLinear, one leg per command"""
         try:
             moving_linear = self.get_group('MovingLinear')              # Get group for later use
         except Exception:
@@ -324,18 +1347,6 @@ class NewportXPS:
             raise
 
         timestamps[-1] = time.time()
-        res_stop, err_stop = self._xps.GatheringStop()
-        try:
-            self.check_error(res_stop, err_stop)
-        except XPSException:
-            raise
-        res_save, err_save = self._xps.GatheringStopAndSave()
-        try:
-            self.check_error(res_save, err_save)
-        except XPSException:
-            raise
-
-        return timestamps
 
     def move_group(self, grp_name, value, nb_item, relative=False, get_group=True):
         """Move a SingleAxisGroup"""
@@ -373,6 +1384,8 @@ class NewportXPS:
         except XPSException:
             raise
 
+        return pos
+
     ### Group actions
     def _group_action(self, method, group):
         try:
@@ -413,7 +1426,7 @@ class NewportXPS:
 
         if homing:
             try:
-                self.home_group(group=group)
+                self.home_group(grp_name)
             except Exception:
                 raise
 
@@ -444,6 +1457,31 @@ class NewportXPS:
 
         return status
         
+    def batch(self, calls, xps=None):
+        """Send several XPS commands back-to-back on one socket
+
+        Parameters
+        ----------
+        calls : list of (string, tuple)
+            XPS method names and their arguments, e.g.
+            [('GroupStatusGet', (group, 0, '')), ...].
+
+        xps : XPS, optional
+            Socket to use (default is a query socket of the pool).
+
+        Returns
+        -------
+        List of the return values in order, each with its own error
+        code. The clr backend falls back to one round trip per call.
+        """
+        if xps is None:
+            xps = self._xps
+        try:
+            batch = xps.batch
+        except AttributeError:
+            return [getattr(xps, method)(*args) for method, args in calls]
+        return batch(calls)
+
     def check_error(self, res, err_string):
         if res != 0:
             raise XPSException(err_string)
@@ -462,11 +1500,44 @@ class NewportXPS:
             self.ftpconn.save(rm_fname, fname)
         except IOError:
             raise
-
-        self.ftpconn.close()
     
+    def read_lines(self, rm_path, rm_fname):
+        """Return the lines of a remote text file"""
+        try:
+            self.ftpconn.connect(**self.ftpargs)
+        except Exception:
+            raise
+        try:
+            self.ftpconn.cwd(os.path.join(self.ftphome, rm_path))
+        except IOError:
+            raise
+        try:
+            lines = self.ftpconn.getlines(rm_fname)
+        except IOError:
+            raise
+        return lines
+
+    def iter_gathering(self, block_size=1 << 20):
+        """Iterate over GATHERING.DAT of the last scan in blocks
+
+        The file is streamed from the controller and parsed block by
+        block into arrays of shape (n, len(self.gathering_types)), so
+        that memory use does not grow with the length of the scan.
+        """
+        try:
+            self.ftpconn.connect(**self.ftpargs)
+        except Exception:
+            raise
+        try:
+            self.ftpconn.cwd(os.path.join(self.ftphome, 'Public'))
+        except IOError:
+            raise
+        for block in self.ftpconn.iterarrays('GATHERING.DAT', len(self.gathering_types),
+                                             skiprows=1, block_size=block_size):
+            yield block
+
     def upload_file(self, rm_path, rm_fname, fname):
-        """Upload file to the remote path"""
+        """Upload the local file fname to the remote path as rm_fname"""
         try:
             self.ftpconn.connect(**self.ftpargs)
         except Exception:
@@ -476,11 +1547,9 @@ class NewportXPS:
         except Exception:
             raise
         try:
-            self.ftpconn.put(rm_fname, fname)
+            self.ftpconn.put(fname, rm_fname)
         except Exception:
             raise
-
-        self.ftpconn.close()
     
     def save_systemini(self):
         try:
@@ -500,6 +1569,23 @@ class NewportXPS:
         except Exception:
             raise
 
+    def load_gathering(self, fname='GATHERING.DAT', cache=True):
+        """Return the gathering data of the last scan as a structured array
+
+        fname is downloaded first if it does not exist. The fields are
+        the gathering types of the scan (see gathering.read_gathering);
+        with cache, later calls map the parsed .npy sidecar instead.
+        """
+        if not os.path.exists(fname):
+            try:
+                self.save_gathering(fname)
+            except Exception:
+                raise
+        try:
+            return read_gathering(fname, types=self.gathering_types or None, cache=cache)
+        except ValueError:
+            raise
+
     def upload_systemini(self):
         try:
             self.upload_file('Config', 'system.ini', 'system.ini')
@@ -515,7 +1601,7 @@ class NewportXPS:
     def get_motion_params(self, positioner):
         """Get the SGamma profile parameters of the positioner"""
         try:
-            positioner_name = get_positioner(positioner)
+            positioner_name = self.get_positioner(positioner)
         except Exception:
             raise
         try:
@@ -540,7 +1626,7 @@ class NewportXPS:
             except Exception:
                 raise
 
-            for i in len(motion_params):
+            for i in range(len(motion_params)):
                 if motion_params[i] is None:    # Set to default values if None
                     motion_params[i] = default_values[i]
             vel, acc, min_jerk, max_jerk = motion_params[0], motion_params[1], motion_params[2], motion_params[3]
@@ -548,7 +1634,7 @@ class NewportXPS:
             print('Error: Could not set the motion parameters')
             raise
         try:
-            positioner_name = get_positioner(positioner)
+            positioner_name = self.get_positioner(positioner)
         except Exception:
             raise
         res, err = self._xps.PositionerSGammaParametersSet(positioner_name,
@@ -560,29 +1646,97 @@ class NewportXPS:
             raise
 
     def get_group(self, grp_name):
-        # TODO
-        # This function should return the group names correspond to
-        # the following inputs: "PointingLinear", "PointingRotary",
-        # and "Moving Linear". The returned name could be used to
-        # Call XPS functions
-        pass
+        """Return the XPS group name of "PointingLinear", "PointingRotary"
+        or "MovingLinear" (or of any group name in system.ini)"""
+        group = self.group_names.get(grp_name, grp_name)
+        if group not in self.groups:
+            raise XPSException('Error: Group {0} is not in system.ini'.format(group))
+        return group
 
     def get_positioner(self, grp_name):
-        # TODO
-        # This function should return GroupName.PositionerName that
-        # correspond to the following inputs: "PointingLinear", 
-        # "PointingRotary", and "Moving Linear". The returned name 
-        # could be used to call XPS functions
-        pass
-
-    def stop_all(self):
-        """Abort any ongoing motions of the groups"""
-        for g in self.groups:
+        """Return GroupName.PositionerName of a SingleAxisGroup"""
+        try:
+            group = self.get_group(grp_name)
+        except XPSException:
+            raise
+        return '{0}.{1}'.format(group, self.groups[group]['positioners'][0])
+
+    def stop_all(self, timeout=5.0, poll_interval=0.001):
+        """Abort any ongoing motions of the groups
+
+        GroupMoveAbort is sent for all groups at once on the reserved
+        abort socket, which is never blocked by a motion. Groups that
+        it cannot stop (homing or referencing, see UNABORTABLE_STATES)
+        are killed with GroupKill and must be initialized again; they
+        are listed in self.killed_groups. The group status is then
+        polled on the same socket until no group is moving.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum time in seconds to wait for the groups to stop
+            (default is 5).
+
+        poll_interval : float
+            Time in seconds between two status polls (default is 1 ms).
+
+        Returns
+        -------
+        Time in seconds from the call to the confirmed stop.
+        """
+        t_start = time.perf_counter()
+        abort = self._xps.abort_socket()
+        groups = [self.get_group(g) for g in self.groups]
+        self.killed_groups = []
+
+        rejected = []
+        replies = self.batch([('GroupMoveAbort', (g, '')) for g in groups], xps=abort)
+        for g, (res, err) in zip(groups, replies):
+            if res == -22:
+                rejected.append(g)
+                continue
             try:
-                self.stop_group(g)
-            except Exception:
+                self.check_error(res, err)
+            except XPSException:
                 raise
 
+        if rejected:
+            replies = self.batch([('GroupStatusGet', (g, 0, '')) for g in rejected], xps=abort)
+            for g, (res, status, err) in zip(rejected, replies):
+                try:
+                    self.check_error(res, err)
+                except XPSException:
+                    print('Error: Unable to check the group status')
+                    raise
+                if status in UNABORTABLE_STATES:
+                    self.killed_groups.append(g)
+                else:
+                    print('Not aborting {0}: Group status is not MOVING or JOGGING'.format(g))
+        if self.killed_groups:
+            replies = self.batch([('GroupKill', (g, '')) for g in self.killed_groups], xps=abort)
+            for g, (res, err) in zip(self.killed_groups, replies):
+                try:
+                    self.check_error(res, err)
+                except XPSException:
+                    print('Error: Unable to kill {0}'.format(g))
+                    raise
+                print('Killed {0}: homing or referencing cannot be aborted'.format(g))
+
+        while True:
+            replies = self.batch([('GroupStatusGet', (g, 0, '')) for g in groups], xps=abort)
+            for res, status, err in replies:
+                try:
+                    self.check_error(res, err)
+                except XPSException:
+                    print('Error: Unable to check the group status')
+                    raise
+            elapsed = time.perf_counter() - t_start
+            if all(status not in MOTION_STATES + UNABORTABLE_STATES for _, status, _ in replies):
+                return elapsed
+            if elapsed > timeout:
+                raise XPSException('Error: Groups still moving {0:.3f} s after abort'.format(elapsed))
+            time.sleep(poll_interval)
+
     def pause_all(self):
         """Pause the system by disabling all groups"""
         for g in self.groups:
@@ -628,7 +1782,7 @@ class NewportXPS:
         except Exception:
             raise
 
-    def disable_group(self):
+    def disable_group(self, grp_name):
         try:
             group = self.get_group(grp_name)
         except Exception:
@@ -640,7 +1794,7 @@ class NewportXPS:
         except Exception:
             raise
 
-    def enable_group(self):
+    def enable_group(self, grp_name):
         try:
             group = self.get_group(grp_name)
         except Exception:
@@ -652,10 +1806,14 @@ class NewportXPS:
         except Exception:
             raise
 
-    def reboot(self, reconnect=True):
+    def reboot(self, reconnect=True, timeout=120.0):
         """Reboot the XPS controller
         
         Can be used when applying changes in sytem.ini or stages.ini
+
+        The controller drops all its sockets, so the whole pool (query
+        sockets and abort socket) is closed and, if reconnect, opened
+        again once the controller answers, within timeout seconds.
         """
         self.ftpconn.close()
         res_close, err_close = self._xps.CloseAllOtherSockets('')
@@ -669,21 +1827,51 @@ class NewportXPS:
             self.check_error(res_reboot, err_reboot)
         except XPSException:
             raise
+        self._xps.CloseInstrument()
 
         if reconnect:
-            try:
-                self.connect(new_socket=False)
-            except Exception:
-                raise
+            t_start = time.time()
+            while True:
+                try:
+                    self.connect()
+                except XPSException:
+                    if time.time() - t_start > timeout:
+                        print('Error: XPS did not come back {0:.0f} s after reboot'.format(timeout))
+                        raise
+                    time.sleep(1.0)
+                else:
+                    break
 
     def close(self):
+        if self.ftpconn is not None:
+            self.ftpconn.close()
         res = self._xps.CloseInstrument()
         if res != 0:
             raise XPSException('Error: Could not close the socket')
 
     def status(self):
-        # TODO
-        pass
+        """Report the status of all groups
+
+        The status codes and their descriptions are read in two
+        pipelined exchanges.
+        """
+        groups = list(self.groups)
+        replies = self.batch([('GroupStatusGet', (g, 0, '')) for g in groups])
+        for res, status, err in replies:
+            try:
+                self.check_error(res, err)
+            except XPSException:
+                print('Error: Unable to check the group status')
+                raise
+
+        codes = [status for _, status, _ in replies]
+        descriptions = self.batch([('GroupStatusStringGet', (c, '', '')) for c in codes])
+        lines = ['Firmware: {0}'.format(self.firmware_ver)]
+        for g, code, (res, text, err) in zip(groups, codes, descriptions):
+            if res != 0:
+                text = 'Unknown status'
+            lines.append('{0}: {1} ({2})'.format(g, code, text))
+        return '\n'.join(lines)
 
 if __name__ == '__main__':
     xps = NewportXPS(host='164.54.160.000', port=5001, timeout=10)
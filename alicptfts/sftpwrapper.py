@@ -1,54 +1,275 @@
 # Adapted from Mathew Newville's code
 # https://github.com/pyepics/newportxps/blob/master/newportxps/ftp_wrapper.py
 
-import pysftp
+import collections
+import hashlib
+import os
+import time
+import warnings
+import numpy as np
 from io import BytesIO
 
 class SFTPWrapper():
-    def __init__(self):
+    """SFTP session to the XPS controller
+
+    The session is kept open between transfers: connect() reuses a live
+    session to the same host and only returns to the home directory,
+    and a transfer that fails because the link dropped is retried once
+    on a new session. The duration of every transfer is recorded in
+    self.transfers.
+
+    Parameters
+    ----------
+    port : int
+        SSH port of the controller (default is 22).
+
+    keepalive : int
+        Interval in seconds of the SSH keepalive packets (default is 30,
+        0 to disable).
+    """
+    def __init__(self, port=22, keepalive=30):
         self.host = None
+        self.port = port
         self.username = None
         self.password = None
+        self.keepalive = keepalive
         self._conn = None
+        self._home = None
+        self._cwd = None
+        # (operation, remote file, bytes, seconds) of the latest transfers
+        self.transfers = collections.deque(maxlen=1000)
 
     def connect(self, host=None, username=None, password=None):
+        if (self.is_alive() and (host, username, password) ==
+                (self.host, self.username, self.password)):
+            try:
+                self._conn.cwd(self._home)
+            except IOError:
+                raise
+            self._cwd = self._home
+            return
+
+        self.close()
         self.host = host
         self.username = username
         self.password = password
+        try:
+            self._open()
+        except Exception:
+            raise
+
+    def _open(self):
+        import pysftp                   # paramiko is slow to import
+        t_start = time.perf_counter()
         try:
             self._conn = pysftp.Connection(host=self.host,
                                            username=self.username,
-                                           password=self.username)
+                                           password=self.password,
+                                           port=self.port)
         except:
             print('SFTP Error: SFTP connection to {0} failed'.format(self.host))
             print('May need to add the host keys for the XPS to the')
             print('ssh known_hosts file, using a command like this:')
             print(' ssh-keyscan {0} >> ~/.ssh/known_hosts'.format(self.host))
             raise
+        if self.keepalive:
+            self._conn._transport.set_keepalive(self.keepalive)
+        self._home = self._conn.pwd
+        self._cwd = self._home
+        self.transfers.append(('connect', self.host, 0, time.perf_counter() - t_start))
+
+    def is_alive(self):
+        """True if the SSH session is open"""
+        if self._conn is None:
+            return False
+        transport = getattr(self._conn, '_transport', None)
+        return transport is not None and transport.is_active()
+
+    def _reconnect(self):
+        print('SFTP: Connection to {0} lost, reconnecting'.format(self.host))
+        cwd = self._cwd
+        self.close()
+        try:
+            self._open()
+        except Exception:
+            raise
+        self._conn.cwd(cwd)
+        self._cwd = cwd
+
+    def _call(self, operation, remotefile, transfer):
+        """Run transfer(connection), on a new session if the link dropped
+
+        transfer returns the number of bytes moved, which is recorded
+        in self.transfers with the duration.
+        """
+        t_start = time.perf_counter()
+        try:
+            nbytes = transfer(self._conn)
+        except Exception:
+            if self.is_alive():
+                raise
+            try:
+                self._reconnect()
+            except Exception:
+                raise
+            nbytes = transfer(self._conn)
+        self.transfers.append((operation, remotefile, nbytes, time.perf_counter() - t_start))
 
     def close(self):
         if self._conn is not None:
-            self._conn.close()
+            try:
+                self._conn.close()
+            except Exception:
+                pass
         self._conn = None
 
     def cwd(self, remotedir):
+        def chdir(conn):
+            conn.cwd(remotedir)
+            return 0
         try:
-            self._conn.cwd(remotedir)
+            self._call('cwd', remotedir, chdir)
         except IOError:
             print('Error: Could not find path')
             raise
+        self._cwd = self._conn.pwd
+
+    def stat(self, remotefile):
+        """Return (size, mtime) of a remote file"""
+        attrs = []
+        def stat(conn):
+            attrs.append(conn.stat(remotefile))
+            return 0
+        try:
+            self._call('stat', remotefile, stat)
+        except IOError:
+            raise
+        return attrs[-1].st_size, attrs[-1].st_mtime
 
     def save(self, remotefile, localfile):
         "Save a remote file to a local file"
         try:
-            self._conn.get(remotepath=remotefile, localpath=localfile)
+            self.download(remotefile, localfile)
         except IOError:
             print('Error: Could not save file')
             raise
 
+    def download(self, remotefile, localfile, block_size=1 << 20, retries=3, checksum=False):
+        """Download a remote file with pipelined reads and resume
+
+        All the read requests from the resume offset to the end of the
+        file are sent at once (SFTP prefetch) and the replies written
+        to the local file, preallocated to the remote size. The offset
+        up to which the local file is complete is kept in
+        localfile + '.part', so that a download interrupted by a
+        disconnect resumes from there, on a new session in this call or
+        in a later call while the remote file is unchanged. The result
+        is checked against the remote size.
+
+        Parameters
+        ----------
+        block_size : int
+            Bytes written between two updates of the resume offset
+            (default is 1 MB).
+
+        retries : int
+            Number of reconnections before giving up (default is 3).
+
+        checksum : bool
+            If True, also compare the MD5 of the local file with the
+            one computed by the server (check-file extension, if the
+            server supports it), at the cost of a full read of the
+            file on the controller (default is False).
+
+        Returns
+        -------
+        Throughput in MB/s.
+        """
+        journal = localfile + '.part'
+        t_start = time.perf_counter()
+        nbytes = 0
+        attempts = 0
+        while True:
+            try:
+                for n in self._download(remotefile, localfile, journal, block_size):
+                    nbytes += n
+                break
+            except Exception:
+                if self.is_alive() or attempts >= retries:
+                    raise
+                attempts += 1
+                try:
+                    self._reconnect()
+                except Exception:
+                    raise
+        try:
+            checked = self._verify(remotefile, localfile, checksum)
+        except IOError:
+            raise
+        if os.path.exists(journal):
+            os.remove(journal)
+
+        elapsed = time.perf_counter() - t_start
+        self.transfers.append(('download', remotefile, nbytes, elapsed))
+        rate = nbytes / elapsed / 1e6
+        print('SFTP: {0} downloaded at {1:.1f} MB/s ({2} checked)'.format(remotefile, rate, checked))
+        return rate
+
+    def _download(self, remotefile, localfile, journal, block_size):
+        """Fill localfile from the resume offset, yielding the bytes written"""
+        attrs = self._conn.stat(remotefile)
+        size, mtime = attrs.st_size, attrs.st_mtime
+        offset = 0
+        if os.path.exists(journal) and os.path.exists(localfile):
+            with open(journal) as f:
+                fields = f.read().split()
+            if len(fields) == 3 and [int(fields[0]), int(fields[1])] == [size, mtime]:
+                offset = int(fields[2])
+
+        with open(localfile, 'r+b' if offset else 'wb') as local:
+            local.truncate(size)        # preallocate
+            local.seek(offset)
+            with self._conn.open(remotefile, 'rb') as remote:
+                remote.seek(offset)
+                remote.prefetch(size)
+                while offset < size:
+                    data = remote.read(min(block_size, size - offset))
+                    if not data:
+                        raise IOError('Unexpected end of {0}'.format(remotefile))
+                    local.write(data)
+                    local.flush()
+                    offset += len(data)
+                    with open(journal, 'w') as f:
+                        f.write('{0} {1} {2}\n'.format(size, mtime, offset))
+                    yield len(data)
+
+    def _verify(self, remotefile, localfile, checksum):
+        """Compare localfile with remotefile; return what was compared"""
+        size = self._conn.stat(remotefile).st_size
+        if os.path.getsize(localfile) != size:
+            raise IOError('Size of {0} differs from the remote file'.format(localfile))
+        if not checksum:
+            return 'size'
+        try:
+            with self._conn.open(remotefile, 'rb') as remote:
+                remote_md5 = remote.check('md5')
+        except IOError:
+            return 'size'               # check-file not supported
+
+        md5 = hashlib.md5()
+        with open(localfile, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+        if md5.digest() != remote_md5:
+            raise IOError('Checksum of {0} differs from the remote file'.format(localfile))
+        return 'size and MD5'
+
     def put(self, localfile, remotefile):
+        def put(conn):
+            conn.put(localpath=localfile, remotepath=remotefile)
+            return os.path.getsize(localfile)
         try:
-            self._conn.put(localpath=localfile, remotepath=remotefile)
+            self._call('put', remotefile, put)
         except IOError:
             print('SFTP Error: Remote path does not exist')
             raise
@@ -62,8 +283,13 @@ class SFTPWrapper():
     def getlines(self, remotefile):
         "Read text of a remote file"
         tmp = BytesIO()
+        def getfo(conn):
+            tmp.seek(0)
+            tmp.truncate()
+            conn.getfo(remotefile, tmp)
+            return tmp.tell()
         try:
-            self._conn.getfo(remotefile, tmp)
+            self._call('getlines', remotefile, getfo)
         except:
             print('SFTP Error: Could not read remotefile')
             raise
@@ -72,7 +298,137 @@ class SFTPWrapper():
             text = bytes2str(tmp.read())
             return(text.split('\n'))
 
+    def iterblocks(self, remotefile, block_size=1 << 20, window=1 << 22):
+        """Iterate over the bytes of a remote file block by block
+
+        Read requests are sent for at most window bytes (default is
+        4 MB, at least one block) ahead of the block being read, so
+        that memory stays bounded whatever the file size and however
+        slow the consumer. If the link drops, the session is
+        reopened once and the file read on from the same offset.
+        """
+        t_start = time.perf_counter()
+        offset = 0
+        size = None
+        retried = False
+        while size is None or offset < size:
+            try:
+                if size is None:
+                    size = self._conn.stat(remotefile).st_size
+                with self._conn.open(remotefile, 'rb') as f:
+                    while offset < size:
+                        end = min(size, offset + max(window, block_size))
+                        chunks = [(o, min(block_size, end - o))
+                                  for o in range(offset, end, block_size)]
+                        for data in f.readv(chunks):
+                            offset += len(data)
+                            yield data
+            except Exception:
+                if self.is_alive() or retried:
+                    raise
+                retried = True
+                try:
+                    self._reconnect()
+                except Exception:
+                    raise
+        self.transfers.append(('iterblocks', remotefile, offset, time.perf_counter() - t_start))
+
+    def iterlines(self, remotefile, block_size=1 << 16):
+        """Iterate over the lines of a remote file
+
+        The file is streamed block_size bytes at a time (see
+        iterblocks), so that memory does not grow with the file size.
+        Yields the same lines as getlines.
+        """
+        for line in _lines(self.iterblocks(remotefile, block_size)):
+            yield line
+
+    def iterarrays(self, remotefile, ncols, skiprows=0, block_size=1 << 20):
+        """Iterate over the numbers of a remote text file as arrays
+
+        Each block of block_size bytes is parsed, without decoding to
+        text lines, into an array of shape (n, ncols) of the complete
+        lines it holds. Useful for GATHERING.DAT (skiprows=1 for the
+        header line).
+        """
+        for block in _arrays(self.iterblocks(remotefile, block_size), ncols, skiprows):
+            yield block
+
+    def timing(self):
+        """Summary of the recorded transfers per operation
+
+        Returns
+        -------
+        dict of {operation : (count, bytes, seconds)}
+        """
+        summary = collections.OrderedDict()
+        for operation, _, nbytes, seconds in self.transfers:
+            count, total, elapsed = summary.get(operation, (0, 0, 0.0))
+            summary[operation] = (count + 1, total + nbytes, elapsed + seconds)
+        return summary
+
+def iter_lines(f, block_size=1 << 16):
+    """Decoded lines of the binary file object f, read block by block
+
+    Yields the same lines as bytes2str(f.read()).split('\\n').
+    """
+    return _lines(iter(lambda: f.read(block_size), b''))
+
+def iter_arrays(f, ncols, skiprows=0, block_size=1 << 20):
+    """Arrays of shape (n, ncols) parsed from the binary file object f
+
+    The file holds whitespace-separated numbers, ncols per line. It is
+    read block by block and every array holds the complete lines of
+    one block. The first skiprows lines are skipped.
+    """
+    return _arrays(iter(lambda: f.read(block_size), b''), ncols, skiprows)
+
+def _lines(blocks):
+    rest = b''
+    for block in blocks:
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield bytes2str(line)
+    yield bytes2str(rest)
+
+def _arrays(blocks, ncols, skiprows=0):
+    rest = b''
+    for block in blocks:
+        data = rest + block
+        while skiprows > 0 and b'\n' in data:
+            data = data.split(b'\n', 1)[1]
+            skiprows -= 1
+        end = data.rfind(b'\n') + 1 if skiprows == 0 else 0
+        data, rest = data[:end], data[end:]
+        if data.strip():
+            yield parse_array(data, ncols)
+    if skiprows == 0 and rest.strip():
+        yield parse_array(rest, ncols)
+
+def parse_array(data, ncols):
+    """Array of shape (n, ncols) of the whitespace-separated numbers in data
+
+    Parsed by NumPy straight from the bytes. As fromstring stops at the
+    first invalid number, data with blank or invalid lines (fewer
+    values than ncols per line) are split and checked value by value.
+    """
+    lines = data.count(b'\n') + (not data.endswith(b'\n'))
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = np.fromstring(data, dtype=float, sep=' ')
+    except ValueError:
+        values = ()
+    if len(values) != lines * ncols:
+        try:
+            values = np.array(data.split(), dtype=float)
+        except ValueError:
+            raise ValueError('Error: Invalid numbers near {0!r}'.format(data[:80]))
+        if len(values) % ncols:
+            raise ValueError('Error: Lines do not all have {0} values'.format(ncols))
+    return values.reshape(-1, ncols)
+
 def bytes2str(s):
     FTP_ENCODING = 'latin-1'
     return str(s, FTP_ENCODING)
-    
\ No newline at end of file
@@ -0,0 +1,244 @@
+# Reduction of the interferograms of a scan to a spectrum
+#
+# Every sweep (see sweeps.segment_sweeps) gives one interferogram: the
+# detector signal against the optical path difference (OPD), which is
+# opd_factor times the displacement of MovingLinear from the zero path
+# difference (ZPD). The interferograms are resampled on a common,
+# uniform and symmetric OPD grid, apodized, Fourier transformed as one
+# 2-D batch and phase corrected (Mertz or Forman) with the phase of a
+# short double-sided part around ZPD. The spectra are then co-added.
+#
+# Grids, windows and interpolation weights are cached per grid, and
+# the FFT plans by the FFT library, so that reducing the next scan
+# with the same settings only costs the arithmetic.
+#
+# Example
+# -------
+# forward, backward = segment_sweeps(pos, vel, sgamma)
+# result = Spectrometer().reduce(pos, signal, forward + backward)
+# plot(result.frequency, result.spectrum)
+
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import scipy.fft as _fft        # faster, threads over the batch
+    _FFT_KWARGS = {'workers': -1}
+except ImportError:
+    _fft = np.fft
+    _FFT_KWARGS = {}
+
+# Speed of light in mm/ns: a wavenumber in 1/mm times C_MM_NS is in GHz
+C_MM_NS = 299.792458
+
+APODIZATIONS = ('boxcar', 'triangle', 'hann', 'hamming', 'blackman', 'norton-beer')
+PHASE_CORRECTIONS = ('mertz', 'forman', 'none')
+
+Spectrum = namedtuple('Spectrum', ['wavenumber', 'frequency', 'spectrum', 'noise',
+                                   'spectra', 'opd', 'interferograms'])
+
+def window(name, n):
+    """Apodization window of n points centred on n // 2"""
+    x = (np.arange(n) - n // 2) / (n / 2.0)        # -1 to 1
+    if name == 'boxcar':
+        return np.ones(n)
+    if name == 'triangle':
+        return 1 - np.abs(x)
+    if name == 'hann':
+        return 0.5 + 0.5 * np.cos(np.pi * x)
+    if name == 'hamming':
+        return 0.54 + 0.46 * np.cos(np.pi * x)
+    if name == 'blackman':
+        return 0.42 + 0.5 * np.cos(np.pi * x) + 0.08 * np.cos(2 * np.pi * x)
+    if name == 'norton-beer':                   # medium
+        return 0.152442 - 0.136176 * (1 - x**2) + 0.983734 * (1 - x**2)**2
+    raise ValueError('Error: Unknown apodization {0}, use one of {1}'.format(name, APODIZATIONS))
+
+class Spectrometer:
+    """Interferogram to spectrum reduction
+
+    Parameters
+    ----------
+    opd_factor : float
+        Optical path difference per unit of stage displacement
+        (default is 2, a mirror moving in one arm of a Michelson).
+
+    dx : float, optional
+        Step of the OPD grid (default is the median OPD step of the
+        first sweep).
+
+    opd_max : float, optional
+        Half width of the OPD grid (default is the largest one covered
+        by every sweep on both sides of ZPD).
+
+    apodization : string
+        One of APODIZATIONS (default is 'hann').
+
+    phase_correction : string
+        One of PHASE_CORRECTIONS (default is 'mertz').
+
+    phase_points : int
+        Half width in points of the double-sided part used to measure
+        the phase (default is 64).
+    """
+    def __init__(self, opd_factor=2.0, dx=None, opd_max=None, apodization='hann',
+                 phase_correction='mertz', phase_points=64):
+        if phase_correction not in PHASE_CORRECTIONS:
+            raise ValueError('Error: Unknown phase correction {0}, use one of {1}'.format(
+                             phase_correction, PHASE_CORRECTIONS))
+        window(apodization, 2)
+        self.opd_factor = opd_factor
+        self.dx = dx
+        self.opd_max = opd_max
+        self.apodization = apodization
+        self.phase_correction = phase_correction
+        self.phase_points = phase_points
+        self._cache = {}
+
+    def grid(self, m, dx):
+        """Cached arrays of the OPD grid of 2 * m points of step dx"""
+        key = (m, dx)
+        if key not in self._cache:
+            n = 2 * m
+            p = min(self.phase_points, m)
+            wavenumber = _fft.rfftfreq(n, dx)
+            short = _fft.rfftfreq(2 * p, dx)
+            # Linear interpolation from the short to the full wavenumbers
+            idx = np.clip(np.searchsorted(short, wavenumber), 1, len(short) - 1)
+            weight = np.clip((wavenumber - short[idx - 1]) / (short[idx] - short[idx - 1]), 0, 1)
+            self._cache[key] = dict(opd=(np.arange(n) - m) * dx,
+                                    window=window(self.apodization, n),
+                                    phase_window=window('hann', 2 * p),
+                                    phase_points=p,
+                                    wavenumber=wavenumber,
+                                    interp=(idx, weight))
+        return self._cache[key]
+
+    ## Interferograms
+    def find_zpd(self, position, signal, sweeps):
+        """Stage position of ZPD: median position of the peak of |signal|"""
+        peaks = []
+        for s in sweeps:
+            sig = np.asarray(signal[s], dtype=float)
+            peaks.append(position[s][np.argmax(np.abs(sig - np.median(sig)))])
+        return float(np.median(peaks))
+
+    def resample(self, position, signal, sweeps, zpd=None):
+        """Interferograms of the sweeps on a uniform OPD grid
+
+        Parameters
+        ----------
+        position, signal : array of float
+            Gathered position of MovingLinear and detector signal,
+            sample by sample.
+
+        sweeps : list of slice
+            Sweeps to use (see sweeps.segment_sweeps).
+
+        zpd : float, optional
+            Stage position of ZPD (default is found by find_zpd).
+
+        Returns
+        -------
+        (opd, interferograms, dx) : array of shape (n,), array of shape
+        (len(sweeps), n) and the grid step.
+        """
+        if not sweeps:
+            raise ValueError('Error: No sweep to resample')
+        position = np.asarray(position)
+        if zpd is None:
+            zpd = self.find_zpd(position, signal, sweeps)
+        opds = []
+        for s in sweeps:
+            opd = (position[s] - zpd) * self.opd_factor
+            sig = np.asarray(signal[s], dtype=float)
+            if opd[-1] < opd[0]:                # backward sweep
+                opd, sig = opd[::-1], sig[::-1]
+            opds.append((opd, sig))
+
+        dx = self.dx
+        if dx is None:
+            dx = float(np.median(np.diff(opds[0][0])))
+            if dx <= 0:
+                raise ValueError('Error: OPD of the first sweep is not increasing')
+        reach = min(min(-opd[0], opd[-1]) for opd, _ in opds)
+        if self.opd_max is not None:
+            reach = min(reach, self.opd_max)
+        m = int(reach / dx)
+        if m < 2:
+            raise ValueError('Error: Sweeps do not cover both sides of ZPD')
+
+        grid = self.grid(m, dx)
+        interferograms = np.empty((len(opds), 2 * m))
+        for row, (opd, sig) in zip(interferograms, opds):
+            row[:] = np.interp(grid['opd'], opd, sig)
+        return grid['opd'], interferograms, dx
+
+    ## Spectra
+    def transform(self, interferograms, dx):
+        """Phase corrected spectra of interferograms (rows) on the OPD grid
+
+        Returns
+        -------
+        (wavenumber, spectra) : wavenumbers in 1/(unit of OPD) and an
+        array with one spectrum per interferogram.
+        """
+        interferograms = np.asarray(interferograms, dtype=float)
+        m = interferograms.shape[1] // 2
+        grid = self.grid(m, dx)
+        p = grid['phase_points']
+        igm = interferograms - interferograms.mean(axis=1, keepdims=True)
+
+        if self.phase_correction == 'none':
+            spectra = np.abs(self._rfft(igm * grid['window']))
+            return grid['wavenumber'], spectra
+
+        # Phase of the short double-sided part around ZPD
+        short = self._rfft(igm[:, m - p:m + p] * grid['phase_window'])
+        phase = np.unwrap(np.angle(short), axis=1)
+        idx, weight = grid['interp']
+        phase = phase[:, idx - 1] * (1 - weight) + phase[:, idx] * weight
+
+        if self.phase_correction == 'mertz':
+            spectra = (self._rfft(igm * grid['window']) * np.exp(-1j * phase)).real
+        else:                                   # forman
+            short_phase = np.unwrap(np.angle(short), axis=1)
+            kernel = _fft.irfft(np.exp(-1j * short_phase), 2 * p, axis=1)
+            kernel = np.fft.fftshift(kernel, axes=1) * grid['phase_window']
+            n = igm.shape[1]
+            nfft = n + 2 * p
+            conv = _fft.irfft(_fft.rfft(igm, nfft, axis=1, **_FFT_KWARGS) *
+                              _fft.rfft(kernel, nfft, axis=1, **_FFT_KWARGS),
+                              nfft, axis=1, **_FFT_KWARGS)[:, p:p + n]
+            spectra = self._rfft(conv * grid['window']).real
+        return grid['wavenumber'], spectra
+
+    def _rfft(self, igm):
+        """FFT of interferograms centred on ZPD (moved to index 0)"""
+        return _fft.rfft(np.fft.ifftshift(igm, axes=1), axis=1, **_FFT_KWARGS)
+
+    def reduce(self, position, signal, sweeps, zpd=None):
+        """Co-added spectrum of the sweeps of a scan
+
+        Parameters
+        ----------
+        position, signal, sweeps, zpd :
+            See resample.
+
+        Returns
+        -------
+        Spectrum with the wavenumbers (1/mm for positions in mm), the
+        frequencies (GHz), the co-added spectrum, its noise (standard
+        error of the mean over the sweeps), the spectrum of every
+        sweep and the resampled interferograms.
+        """
+        opd, interferograms, dx = self.resample(position, signal, sweeps, zpd)
+        wavenumber, spectra = self.transform(interferograms, dx)
+        spectrum = spectra.mean(axis=0)
+        if len(spectra) > 1:
+            noise = spectra.std(axis=0, ddof=1) / np.sqrt(len(spectra))
+        else:
+            noise = np.full_like(spectrum, np.nan)
+        return Spectrum(wavenumber, wavenumber * C_MM_NS, spectrum, noise,
+                        spectra, opd, interferograms)
@@ -0,0 +1,135 @@
+# Segmentation of the gathered trace of a scan into sweeps
+#
+# A sweep is a run of samples where the gathered velocity keeps the
+# same sign (forward: positive). Its ends, where the stage accelerates
+# to and decelerates from the cruise velocity of the SGamma profile,
+# can be trimmed so that only the constant-velocity part is kept.
+# Sweeps are returned as slices, so that data[sweep] is a view.
+#
+# Example
+# -------
+# data = read_gathering('GATHERING.DAT')
+# forward, backward = segment_sweeps(data['CurrentPosition'],
+#                                    data['CurrentVelocity'],
+#                                    sgamma=xps.get_motion_params('MovingLinear'))
+# first = data['CurrentPosition'][forward[0]]
+
+import numpy as np
+
+SGAMMA_KEYS = ('velocity', 'acceleration', 'min_jerk_time', 'max_jerk_time')
+
+def accel_distance(sgamma):
+    """Distance covered while reaching the cruise velocity
+
+    The SGamma profile ramps the acceleration in a jerk time, holds it
+    and ramps it down, so the velocity is symmetric about half the
+    cruise velocity and the distance is v * (v / a + jerk_time) / 2.
+    The longest jerk time is used, as the controller picks one between
+    the minimum and the maximum.
+
+    Parameters
+    ----------
+    sgamma : list or dict
+        [velocity, acceleration, min_jerk_time, max_jerk_time] as from
+        NewportXPS.get_motion_params, or a dict with SGAMMA_KEYS.
+    """
+    if isinstance(sgamma, dict):
+        sgamma = [sgamma[k] for k in SGAMMA_KEYS]
+    vel, acc, min_jerk, max_jerk = [float(x) for x in sgamma]
+    return vel * (vel / acc + max(min_jerk, max_jerk)) / 2
+
+def find_sweeps(velocity, threshold=0.01, min_samples=16):
+    """Runs of samples with the same sign of velocity
+
+    Parameters
+    ----------
+    velocity : array of float
+        Gathered velocity (e.g. CurrentVelocity).
+
+    threshold : float
+        Samples with |velocity| below threshold * max|velocity| are
+        considered at rest, so that noise at the turnarounds does not
+        split a sweep (default is 0.01).
+
+    min_samples : int
+        Shorter runs are dropped (default is 16).
+
+    Returns
+    -------
+    array of int of shape (n, 3): first sample, last sample + 1 and
+    direction (1 forward, -1 backward) of each sweep.
+    """
+    v = np.asarray(velocity)
+    if len(v) == 0:
+        return np.zeros((0, 3), dtype=np.intp)
+    limit = threshold * np.abs(v).max()
+    moving = np.flatnonzero(np.abs(v) > limit)
+    if len(moving) == 0:
+        return np.zeros((0, 3), dtype=np.intp)
+    sign = np.where(v[moving] > 0, 1, -1)
+    change = np.flatnonzero(sign[1:] != sign[:-1]) + 1
+    first = np.concatenate(([0], change))
+    last = np.concatenate((change, [len(moving)])) - 1
+    sweeps = np.column_stack((moving[first], moving[last] + 1, sign[first]))
+    return sweeps[sweeps[:, 1] - sweeps[:, 0] >= min_samples]
+
+def trim_sweeps(sweeps, position, distance):
+    """Drop the samples of each sweep within distance of its ends
+
+    Parameters
+    ----------
+    sweeps : array of int of shape (n, 3)
+        As returned by find_sweeps.
+
+    position : array of float
+        Gathered position (e.g. CurrentPosition).
+
+    distance : float
+        Distance trimmed at both ends (see accel_distance).
+
+    Returns
+    -------
+    array like sweeps; sweeps shorter than 2 * distance are dropped.
+    """
+    position = np.asarray(position)
+    trimmed = sweeps.copy()
+    for row in trimmed:
+        start, stop, direction = row
+        # Monotonic (increasing) in a sweep up to the noise
+        pos = position[start:stop] * direction
+        row[0] = start + np.searchsorted(pos, pos[0] + distance, side='left')
+        row[1] = start + np.searchsorted(pos, pos[-1] - distance, side='right')
+    return trimmed[trimmed[:, 1] > trimmed[:, 0]]
+
+def segment_sweeps(position, velocity, sgamma=None, threshold=0.01, min_samples=16,
+                   margin=0.0):
+    """Split a gathered trace into forward and backward sweeps
+
+    Parameters
+    ----------
+    position, velocity : array of float
+        Gathered position and velocity of the moving stage.
+
+    sgamma : list or dict, optional
+        SGamma parameters of the scan (see accel_distance). If given,
+        the acceleration and deceleration zones are trimmed.
+
+    threshold, min_samples : float, int
+        See find_sweeps.
+
+    margin : float
+        Extra distance trimmed at both ends (default is 0).
+
+    Returns
+    -------
+    (forward, backward) : lists of slice
+        Slices of the samples of every sweep in time order; data[s]
+        is a view of data.
+    """
+    sweeps = find_sweeps(velocity, threshold, min_samples)
+    if sgamma is not None or margin:
+        distance = margin + (accel_distance(sgamma) if sgamma is not None else 0.0)
+        sweeps = trim_sweeps(sweeps, position, distance)
+    forward = [slice(int(start), int(stop)) for start, stop, direction in sweeps if direction > 0]
+    backward = [slice(int(start), int(stop)) for start, stop, direction in sweeps if direction < 0]
+    return forward, backward
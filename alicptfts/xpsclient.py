@@ -0,0 +1,536 @@
+# Native Python implementation of the XPS command interface
+#
+# The wire protocol is taken from the decompiled Newport assembly
+# (lib/newport_assembly_decompiled/TCPIPSocket.cs and XPS.cs):
+# a request is the ASCII string "Command(arg1,arg2,...)" and the
+# reply is "ErrorCode,out1,out2,...,EndOfAPI".
+
+import asyncio
+import socket
+import threading
+
+END_FLAG = b'EndOfAPI'
+ENCODING = 'ascii'
+RECEIVED_BUFFER_SIZE = 65536
+
+# Commands that only reply once the motion has finished.  No receive
+# timeout is applied to them.
+MOTION_COMMANDS = frozenset(('GroupMoveAbsolute',
+                             'GroupMoveRelative',
+                             'GroupHomeSearch',
+                             'GroupInitialize',
+                             'GroupInitializeWithEncoderCalibration',
+                             'MultipleAxesPVTExecution'))
+
+# Maximum number of pipelined commands awaiting a reply, so that the
+# replies never fill up the socket buffers while a batch is being sent
+BATCH_WINDOW = 64
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def get_loop():
+    """Return the event loop shared by all XPS sockets
+
+    The loop runs in a daemon thread so that the blocking XPS class
+    can be used from ordinary (synchronous) code.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever,
+                                      name='xpsclient', daemon=True)
+            thread.start()
+            _loop = loop
+    return _loop
+
+def run(coro):
+    """Run a coroutine on the shared loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+def _double(value):
+    # Same precision as the .NET assembly (m_strPrecision = "F6")
+    return '{0:.6f}'.format(value)
+
+def _fail(err, nb_outputs):
+    return (-1,) + (None,) * nb_outputs + (err,)
+
+def parse_reply(reply, outputs=()):
+    """Split a reply into (error_code, output values..., errstring)
+
+    Parameters
+    ----------
+    reply : bytes or string
+        Reply of the XPS with or without the trailing EndOfAPI.
+
+    outputs : sequence of type
+        Conversion applied to each output value (int, float or str).
+        A str output in the last position takes the remaining text.
+    """
+    if isinstance(reply, (bytes, bytearray)):
+        reply = reply.decode(ENCODING)
+    text = reply.strip()
+    if text.endswith(END_FLAG.decode(ENCODING)):
+        text = text[:-len(END_FLAG)]
+    parts = text.rstrip().rstrip(',').split(',')
+    try:
+        code = int(parts[0])
+    except ValueError:
+        return _fail('Error: Could not parse reply {0}'.format(reply), len(outputs))
+    if code != 0:
+        # Same errstring as the .NET assembly: the error code itself
+        return (code,) + (None,) * len(outputs) + (str(code),)
+
+    values = []
+    for i, conv in enumerate(outputs):
+        if conv is str and i == len(outputs) - 1:
+            token = ','.join(parts[i+1:])
+        else:
+            try:
+                token = parts[i+1]
+            except IndexError:
+                return _fail('Error: Missing value in reply {0}'.format(reply), len(outputs))
+        try:
+            values.append(conv(token.strip()))
+        except ValueError:
+            return _fail('Error: Could not convert {0} in reply {1}'.format(token, reply),
+                         len(outputs))
+
+    return (0,) + tuple(values) + ('',)
+
+class ReplyOutOfStep(ConnectionError):
+    """The replies received no longer match the requests sent"""
+
+class ReplyReader:
+    """Receive buffer splitting a byte stream into XPS replies
+
+    Data is received with large recv_into calls into a reusable
+    bytearray.  Only the newly arrived bytes (plus len(END_FLAG) - 1
+    bytes of overlap) are searched for EndOfAPI, so reading a reply is
+    linear in its size.  Bytes after a terminator stay in the buffer
+    for the next reply, and nothing is decoded here.
+
+    The replies still owed by the controller are counted, so that
+    those of requests given up on a timeout are dropped when they
+    arrive instead of being taken for the replies of later requests.
+    """
+    def __init__(self, size=RECEIVED_BUFFER_SIZE):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0     # first byte of the current reply
+        self._end = 0       # end of the received data
+        self._scan = 0      # no terminator starts before this offset
+        self.pending = 0    # requests sent whose reply has not been read
+        self.stale = 0      # of those, given up: dropped on arrival
+
+    def reset(self):
+        """Forget the received data and the pending replies (new socket)"""
+        self._rewind()
+        self.pending = self.stale = 0
+
+    def _rewind(self):
+        self._start = self._end = self._scan = 0
+
+    def sent(self, nb_requests=1):
+        """Register requests sent on the socket
+
+        Raises ReplyOutOfStep if data were received while no reply was
+        pending: they cannot be matched to any request.
+        """
+        if self.pending == 0 and self._end > self._start:
+            data = bytes(self._view[self._start:self._end])
+            self.reset()
+            raise ReplyOutOfStep('Error: Unexpected data {0!r} from the XPS'.format(data[:80]))
+        self.pending += nb_requests
+
+    def next_reply(self):
+        """Return the next complete reply without EndOfAPI, or None"""
+        i = self._buf.find(END_FLAG, self._scan, self._end)
+        if i == -1:
+            self._scan = max(self._start, self._end - len(END_FLAG) + 1)
+            return None
+        reply = bytes(self._view[self._start:i])
+        self._start = self._scan = i + len(END_FLAG)
+        if self._start == self._end:
+            self._rewind()
+        return reply
+
+    def free_space(self):
+        """Return a writable view on the free end of the buffer"""
+        if self._end == len(self._buf):
+            pending = bytes(self._view[self._start:self._end])
+            if self._start == 0:            # reply larger than the buffer
+                self._view.release()
+                self._buf = bytearray(2 * len(self._buf))
+                self._view = memoryview(self._buf)
+            self._buf[:len(pending)] = pending
+            self._scan -= self._start
+            self._start, self._end = 0, len(pending)
+        return self._view[self._end:]
+
+    def advance(self, nbytes):
+        """Register nbytes received into free_space()"""
+        self._end += nbytes
+
+    async def read(self, sock, timeout=None):
+        """Return the reply of the oldest pending request
+
+        The stale replies received before it are dropped. If the reply
+        does not come within timeout, all the pending requests are
+        given up (see stale) and asyncio.TimeoutError is raised.
+        """
+        if self.pending <= self.stale:
+            raise ReplyOutOfStep('Error: No request is waiting for a reply')
+        try:
+            while True:
+                reply = await self._receive(sock, timeout)
+                self.pending -= 1
+                if self.stale == 0:
+                    return reply
+                self.stale -= 1
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self.stale = self.pending
+            raise
+
+    async def _receive(self, sock, timeout):
+        loop = asyncio.get_running_loop()
+        reply = self.next_reply()
+        while reply is None:
+            nbytes = await asyncio.wait_for(loop.sock_recv_into(sock, self.free_space()),
+                                            timeout)
+            if nbytes == 0:
+                raise ConnectionError('XPS closed the connection')
+            self.advance(nbytes)
+            reply = self.next_reply()
+        return reply
+
+class _Reply:
+    """Awaitable filled in with the parsed reply of a pipelined command"""
+    def __init__(self, command, outputs):
+        self.command = command
+        self.outputs = outputs
+        self.value = None
+
+    def __await__(self):
+        yield self
+        return self.value
+
+class AsyncXPS:
+    """asyncio client for a single XPS socket
+
+    Method names and return values follow the Python.NET calling
+    convention of CommandInterfaceXPS.XPS: out parameters are passed as
+    placeholders and returned as a tuple (res, outputs..., errstring).
+    """
+    def __init__(self):
+        self.host = None
+        self.port = None
+        self.timeout = None         # seconds
+        self._sock = None
+        self._reader = ReplyReader()
+        self._lock = asyncio.Lock()
+        self._queue = None          # _CommandQueue of batch, made once
+
+    async def open(self, host, port=5001, timeout=1000):
+        """Open the socket; timeout in milliseconds"""
+        loop = asyncio.get_running_loop()
+        self.host = host
+        self.port = port
+        self.timeout = timeout / 1000.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (host, port)),
+                                   self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            sock.close()
+            raise
+        self._sock = sock
+        self._reader.reset()
+
+    async def close(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+
+    def is_connected(self):
+        return self._sock is not None
+
+    async def query(self, command):
+        """Send one command and return the raw reply (bytes without EndOfAPI)"""
+        if self._sock is None:
+            raise ConnectionError('XPS socket is not open')
+        name = command.split('(', 1)[0]
+        timeout = None if name in MOTION_COMMANDS else self.timeout
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            await loop.sock_sendall(self._sock, command.encode(ENCODING))
+            self._reader.sent()
+            return await self._reader.read(self._sock, timeout)
+
+    async def execute(self, command, *outputs):
+        """Send a command and return (res, outputs..., errstring)"""
+        try:
+            reply = await self.query(command)
+        except (OSError, asyncio.TimeoutError) as exc:
+            return _fail('Error: {0} failed ({1!r})'.format(command, exc), len(outputs))
+        return parse_reply(reply, outputs)
+
+    async def _pipeline(self, commands):
+        """Send commands back-to-back and read the replies in order
+
+        A socket error is returned in place of the missing replies.
+        """
+        if self._sock is None:
+            return [ConnectionError('XPS socket is not open')] * len(commands)
+        names = [c.split('(', 1)[0] for c in commands]
+        timeout = None if MOTION_COMMANDS.intersection(names) else self.timeout
+        loop = asyncio.get_running_loop()
+        replies = []
+        async with self._lock:
+            try:
+                for i in range(0, len(commands), BATCH_WINDOW):
+                    window = commands[i:i+BATCH_WINDOW]
+                    await loop.sock_sendall(self._sock, ''.join(window).encode(ENCODING))
+                    self._reader.sent(len(window))
+                    for _ in window:
+                        replies.append(await self._reader.read(self._sock, timeout))
+            except (OSError, asyncio.TimeoutError) as exc:
+                replies += [exc] * (len(commands) - len(replies))
+        return replies
+
+    async def batch(self, calls):
+        """Send several commands in a single pipelined exchange
+
+        Parameters
+        ----------
+        calls : list of (string, tuple)
+            Names of the wrapper methods below and their arguments, e.g.
+            [('GroupStatusGet', ('MovingLinear', 0, '')),
+             ('PositionerUserTravelLimitsGet', ('MovingLinear.Pos', 0, 0, ''))]
+
+        Returns
+        -------
+        List of the return values of the calls in order; each one
+        carries its own error code as res.
+        """
+        if self._queue is None:
+            self._queue = _CommandQueue()
+        queue = self._queue
+        results = [None] * len(calls)
+        waiting = []
+        # Run each wrapper until it waits for the reply of its command
+        for i, (method, args) in enumerate(calls):
+            coro = getattr(queue, method)(*args)
+            try:
+                waiting.append((i, coro, coro.send(None)))
+            except StopIteration as stop:
+                results[i] = stop.value
+
+        replies = await self._pipeline([request.command for _, _, request in waiting])
+        for (i, coro, request), reply in zip(waiting, replies):
+            if isinstance(reply, Exception):
+                request.value = _fail('Error: {0} failed ({1!r})'.format(request.command, reply),
+                                      len(request.outputs))
+            else:
+                request.value = parse_reply(reply, request.outputs)
+            try:
+                coro.send(None)
+            except StopIteration as stop:
+                results[i] = stop.value
+        return results
+
+    ## Wrappers with the same signatures as CommandInterfaceXPS.XPS
+    async def OpenInstrument(self, host, port, timeout):
+        try:
+            await self.open(host, port, timeout)
+        except (OSError, asyncio.TimeoutError):
+            return -1
+        return 0
+
+    async def CloseInstrument(self):
+        await self.close()
+        return 0
+
+    async def Login(self, Name, Password, errstring=''):
+        return await self.execute('Login({0},{1})'.format(Name.strip(), Password.strip()))
+
+    async def FirmwareVersionGet(self, Version='', errstring=''):
+        return await self.execute('FirmwareVersionGet(char*)', str)
+
+    async def CloseAllOtherSockets(self, errstring=''):
+        return await self.execute('CloseAllOtherSockets()')
+
+    async def Reboot(self, errstring=''):
+        return await self.execute('Reboot()')
+
+    async def _group_command(self, method, GroupName):
+        return await self.execute('{0}({1})'.format(method, GroupName.strip()))
+
+    async def GroupKill(self, GroupName, errstring=''):
+        return await self._group_command('GroupKill', GroupName)
+
+    async def GroupInitialize(self, GroupName, errstring=''):
+        return await self._group_command('GroupInitialize', GroupName)
+
+    async def GroupInitializeWithEncoderCalibration(self, GroupName, errstring=''):
+        return await self._group_command('GroupInitializeWithEncoderCalibration', GroupName)
+
+    async def GroupHomeSearch(self, GroupName, errstring=''):
+        return await self._group_command('GroupHomeSearch', GroupName)
+
+    async def GroupMoveAbort(self, GroupName, errstring=''):
+        return await self._group_command('GroupMoveAbort', GroupName)
+
+    async def GroupMotionDisable(self, GroupName, errstring=''):
+        return await self._group_command('GroupMotionDisable', GroupName)
+
+    async def GroupMotionEnable(self, GroupName, errstring=''):
+        return await self._group_command('GroupMotionEnable', GroupName)
+
+    async def _group_move(self, method, GroupName, positions, nbItems):
+        if nbItems is None:
+            nbItems = len(positions)
+        args = [GroupName.strip()] + [_double(p) for p in positions[:nbItems]]
+        return await self.execute('{0}({1})'.format(method, ','.join(args)))
+
+    async def GroupMoveAbsolute(self, GroupName, TargetPosition, nbItems=None, errstring=''):
+        return await self._group_move('GroupMoveAbsolute', GroupName, TargetPosition, nbItems)
+
+    async def GroupMoveRelative(self, GroupName, TargetDisplacement, nbItems=None, errstring=''):
+        return await self._group_move('GroupMoveRelative', GroupName, TargetDisplacement, nbItems)
+
+    async def _group_positions(self, method, GroupName, nbItems):
+        command = '{0}({1})'.format(method, ','.join([GroupName.strip()] + ['double*'] * nbItems))
+        ret = await self.execute(command, *([float] * nbItems))
+        return ret[0], list(ret[1:-1]), ret[-1]
+
+    async def GroupPositionSetpointGet(self, GroupName, SetPointPosition, nbItems, errstring=''):
+        return await self._group_positions('GroupPositionSetpointGet', GroupName, nbItems)
+
+    async def GroupPositionCurrentGet(self, GroupName, CurrentEncoderPosition, nbItems, errstring=''):
+        return await self._group_positions('GroupPositionCurrentGet', GroupName, nbItems)
+
+    async def GroupStatusGet(self, GroupName, Status=0, errstring=''):
+        return await self.execute('GroupStatusGet({0},int*)'.format(GroupName.strip()), int)
+
+    async def GroupStatusStringGet(self, GroupStatusCode, GroupStatusString='', errstring=''):
+        return await self.execute('GroupStatusStringGet({0},char*)'.format(int(GroupStatusCode)),
+                                  str)
+
+    async def PositionerMaximumVelocityAndAccelerationGet(self, PositionerName,
+                                                          MaximumVelocity=0.0,
+                                                          MaximumAcceleration=0.0,
+                                                          errstring=''):
+        command = 'PositionerMaximumVelocityAndAccelerationGet({0},double*,double*)'
+        return await self.execute(command.format(PositionerName.strip()), float, float)
+
+    async def PositionerUserTravelLimitsGet(self, PositionerName,
+                                            UserMinimumTarget=0.0,
+                                            UserMaximumTarget=0.0,
+                                            errstring=''):
+        command = 'PositionerUserTravelLimitsGet({0},double*,double*)'
+        return await self.execute(command.format(PositionerName.strip()), float, float)
+
+    async def PositionerSGammaParametersGet(self, PositionerName,
+                                            Velocity=0.0, Acceleration=0.0,
+                                            MinimumTjerkTime=0.0, MaximumTjerkTime=0.0,
+                                            errstring=''):
+        command = 'PositionerSGammaParametersGet({0},double*,double*,double*,double*)'
+        return await self.execute(command.format(PositionerName.strip()),
+                                  float, float, float, float)
+
+    async def PositionerSGammaParametersSet(self, PositionerName,
+                                            Velocity, Acceleration,
+                                            MinimumTjerkTime, MaximumTjerkTime,
+                                            errstring=''):
+        args = [PositionerName.strip()] + [_double(v) for v in (Velocity, Acceleration,
+                                                               MinimumTjerkTime,
+                                                               MaximumTjerkTime)]
+        return await self.execute('PositionerSGammaParametersSet({0})'.format(','.join(args)))
+
+    async def GatheringConfigurationSet(self, Type, errstring=''):
+        return await self.execute('GatheringConfigurationSet({0})'.format(
+                                  ','.join(t.strip() for t in Type)))
+
+    async def GatheringRun(self, DataNumber, Divisor, errstring=''):
+        return await self.execute('GatheringRun({0},{1})'.format(int(DataNumber), int(Divisor)))
+
+    async def GatheringStop(self, errstring=''):
+        return await self.execute('GatheringStop()')
+
+    async def GatheringStopAndSave(self, errstring=''):
+        return await self.execute('GatheringStopAndSave()')
+
+    async def GatheringCurrentNumberGet(self, CurrentNumber=0, MaximumSamplesNumber=0,
+                                        errstring=''):
+        return await self.execute('GatheringCurrentNumberGet(int*,int*)', int, int)
+
+    async def GatheringDataGet(self, IndexPoint, DataBufferLine='', errstring=''):
+        return await self.execute('GatheringDataGet({0},char*)'.format(int(IndexPoint)), str)
+
+    async def GatheringDataMultipleLinesGet(self, IndexPoint, NumberOfLines,
+                                            DataBufferLine='', errstring=''):
+        command = 'GatheringDataMultipleLinesGet({0},{1},char*)'
+        return await self.execute(command.format(int(IndexPoint), int(NumberOfLines)), str)
+
+    async def MultipleAxesPVTResetInMemory(self, GroupName, errstring=''):
+        return await self._group_command('MultipleAxesPVTResetInMemory', GroupName)
+
+    async def MultipleAxesPVTLoadToMemory(self, GroupName, TrajectoryPart, errstring=''):
+        return await self.execute('MultipleAxesPVTLoadToMemory({0},{1})'.format(
+                                  GroupName.strip(), TrajectoryPart.strip()))
+
+    async def MultipleAxesPVTVerification(self, GroupName, TrajectoryFileName, errstring=''):
+        return await self.execute('MultipleAxesPVTVerification({0},{1})'.format(
+                                  GroupName.strip(), TrajectoryFileName.strip()))
+
+    async def MultipleAxesPVTExecution(self, GroupName, TrajectoryFileName, ExecutionNumber,
+                                       errstring=''):
+        return await self.execute('MultipleAxesPVTExecution({0},{1},{2})'.format(
+                                  GroupName.strip(), TrajectoryFileName.strip(),
+                                  int(ExecutionNumber)))
+
+    async def ElapsedTimeGet(self, ElapsedTime=0.0, errstring=''):
+        return await self.execute('ElapsedTimeGet(double*)', float)
+
+    async def TCLScriptExecute(self, TCLFileName, TaskName, ParametersList, errstring=''):
+        return await self.execute('TCLScriptExecute({0},{1},{2})'.format(
+                                  TCLFileName.strip(), TaskName.strip(), ParametersList.strip()))
+
+    async def TCLScriptKill(self, TaskName, errstring=''):
+        return await self.execute('TCLScriptKill({0})'.format(TaskName.strip()))
+
+    async def TCLScriptRunningListGet(self, TCLTaskList='', errstring=''):
+        return await self.execute('TCLScriptRunningListGet(char*)', str)
+
+class _CommandQueue(AsyncXPS):
+    """Stand-in for AsyncXPS.batch: the wrappers queue their commands"""
+    def __init__(self):
+        pass                        # no socket, receive buffer or lock
+
+    async def execute(self, command, *outputs):
+        return await _Reply(command, outputs)
+
+class XPS:
+    """Blocking drop-in replacement for CommandInterfaceXPS.XPS
+
+    Every coroutine of AsyncXPS is exposed as an ordinary method that
+    runs on the shared event loop, e.g.
+    res, status, err = XPS().GroupStatusGet('MovingLinear', 0, '')
+    """
+    def __init__(self):
+        self._async = AsyncXPS()
+
+    def __getattr__(self, name):
+        attr = getattr(self._async, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        def method(*args, **kwargs):
+            return run(attr(*args, **kwargs))
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        return method
@@ -0,0 +1,869 @@
+# Local simulator of an XPS-D controller
+#
+# Speaks the same "Command(args)" / "...,EndOfAPI" TCP protocol as the
+# real controller (see lib/newport_assembly_decompiled/XPS.cs) and
+# models the group state machine, SGamma move durations, data
+# gathering and the TCL scan scripts of NewportXPS.  SimFileStore
+# replaces the SFTP server of the controller.
+#
+# Example
+# -------
+# sim = XPSSimulator(latency=0.002, jitter=0.001)
+# host, port = sim.start()
+# xps = NewportXPS(host, port, ftpconn=sim.filestore)
+
+import asyncio
+import collections
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from configparser import ConfigParser
+
+import numpy as np
+from .sftpwrapper import iter_arrays, iter_lines
+
+END_FLAG = 'EndOfAPI'
+ENCODING = 'ascii'
+
+# Group status codes (XPS Programming Manual Sec. 8.8)
+NOTINIT = 0
+NOTINIT_KILLED = 7
+READY_ABORTED = 10
+READY_HOMED = 11
+READY_MOTION = 12
+READY_ENABLED = 13
+DISABLED = 20
+NOTREF = 42
+HOMING = 43
+MOVING = 44
+TRAJECTORY = 45
+
+READY_STATES = range(10, 19)
+
+STATUS_STRINGS = {
+    NOTINIT: 'Not initialized state',
+    NOTINIT_KILLED: 'Not initialized state due to a GroupKill or KillAll command',
+    READY_ABORTED: 'Ready state due to an AbortMove command',
+    READY_HOMED: 'Ready state from homing',
+    READY_MOTION: 'Ready state from motion',
+    READY_ENABLED: 'Ready state due to a MotionEnable command',
+    DISABLED: 'Disable state',
+    NOTREF: 'Not referenced state',
+    HOMING: 'Homing state',
+    MOVING: 'Moving state',
+    TRAJECTORY: 'Trajectory state',
+}
+
+# Error codes
+ERR_UNKNOWN_COMMAND = -4
+ERR_WRONG_FORMAT = -7
+ERR_PARAMETERS_NUMBER = -8
+ERR_OUT_OF_RANGE = -17
+ERR_POSITIONER_NAME = -18
+ERR_GROUP_NAME = -19
+ERR_NOT_ALLOWED = -22
+ERR_MOVE_ABORTED = -27
+ERR_GATHERING_TYPE = -29
+ERR_GATHERING_NOT_STARTED = -30
+ERR_GATHERING_NOT_CONFIGURED = -32
+
+# Root of the controller file system as seen by TCL scripts
+XPS_HOME = '/Admin'
+
+GATHERING_TYPES = ('CurrentPosition', 'CurrentVelocity', 'CurrentAcceleration',
+                   'SetpointPosition', 'SetpointVelocity', 'SetpointAcceleration')
+
+DEFAULT_SYSTEMINI = """[GENERAL]
+BootScriptFileName =
+BootScriptArguments =
+[GROUPS]
+SingleAxisInUse = PointingLinear, PointingRotary, MovingLinear
+SpindleInUse =
+XYInUse =
+XYZInUse =
+MultipleAxesInUse =
+[PointingLinear]
+PositionerInUse = Pos
+[PointingLinear.Pos]
+PlugNumber = 1
+StageName = TRB@TRB25CC@XPS-DRV11-DIGITAL
+[PointingRotary]
+PositionerInUse = Pos
+[PointingRotary.Pos]
+PlugNumber = 2
+StageName = SR@SR50CC@XPS-DRV11-DIGITAL
+[MovingLinear]
+PositionerInUse = Pos
+[MovingLinear.Pos]
+PlugNumber = 3
+StageName = LTA@LTA-HL@XPS-DRV11-DIGITAL
+"""
+
+DEFAULT_STAGE = dict(position=0.0,
+                     min_target=-12.5,
+                     max_target=12.5,
+                     max_velocity=5.0,
+                     max_acceleration=20.0,
+                     velocity=2.5,
+                     acceleration=10.0,
+                     min_jerk_time=0.005,
+                     max_jerk_time=0.05)
+
+class SimError(Exception):
+    """Error code returned to the client instead of a result"""
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+class SGammaProfile:
+    """Point-to-point move between two positions
+
+    The SGamma profile is approximated by a trapezoidal velocity
+    profile whose acceleration phase is lengthened by the jerk time,
+    so that its duration is d/v + v/a + t_jerk (or 2*sqrt(d/a_eff)
+    when the velocity is never reached).
+    """
+    def __init__(self, start, end, velocity, acceleration, jerk_time=0.0, t0=0.0):
+        self.start = float(start)
+        self.end = float(end)
+        self.t0 = t0
+        distance = abs(self.end - self.start)
+        self.direction = 1.0 if self.end >= self.start else -1.0
+        acc = velocity / (velocity / acceleration + jerk_time)
+        if distance >= velocity**2 / acc:       # trapezoid
+            self.t_acc = velocity / acc
+            self.t_flat = distance / velocity - self.t_acc
+        else:                                   # triangle
+            self.t_acc = np.sqrt(distance / acc)
+            self.t_flat = 0.0
+        self.vmax = acc * self.t_acc
+        self.acc = acc
+        self.duration = 2 * self.t_acc + self.t_flat
+
+    def sample(self, t):
+        """Return (position, velocity, acceleration) at times t"""
+        tau = np.clip(np.asarray(t, dtype=float) - self.t0, 0.0, self.duration)
+        t1 = self.t_acc
+        t2 = self.t_acc + self.t_flat
+        td = np.clip(tau - t2, 0.0, None)
+        dist = np.where(tau < t1, 0.5 * self.acc * tau**2,
+                        np.where(tau < t2, 0.5 * self.acc * t1**2 + self.vmax * (tau - t1),
+                                 0.5 * self.acc * t1**2 + self.vmax * self.t_flat
+                                 + self.vmax * td - 0.5 * self.acc * td**2))
+        vel = np.where(tau < t1, self.acc * tau,
+                       np.where(tau < t2, self.vmax, self.vmax - self.acc * td))
+        acc = np.where(tau < t1, self.acc, np.where(tau < t2, 0.0, -self.acc))
+        moving = (tau > 0) & (tau < self.duration)
+        vel = np.where(moving, vel, 0.0)
+        acc = np.where(moving, acc, 0.0)
+        return (self.start + self.direction * dist,
+                self.direction * vel,
+                self.direction * acc)
+
+class PVTProfile:
+    """PVT trajectory from elements (dt, dx, v_end)
+
+    Each element is interpolated by the cubic that matches the
+    positions and velocities at both ends, as done by the controller.
+    """
+    def __init__(self, start, elements, t0=0.0):
+        elements = np.asarray(elements, dtype=float).reshape(-1, 3)
+        self.dt = elements[:, 0]
+        self.t_edges = t0 + np.concatenate(([0.], np.cumsum(self.dt)))
+        self.p_edges = start + np.concatenate(([0.], np.cumsum(elements[:, 1])))
+        self.v_edges = np.concatenate(([0.], elements[:, 2]))
+        self.t0 = t0
+        self.duration = self.t_edges[-1] - t0
+        self.end = self.p_edges[-1]
+
+    def sample(self, t):
+        """Return (position, velocity, acceleration) at times t"""
+        t = np.asarray(t, dtype=float)
+        i = np.clip(np.searchsorted(self.t_edges, t, side='right') - 1, 0, len(self.dt) - 1)
+        T = self.dt[i]
+        s = np.clip(t - self.t_edges[i], 0.0, T)
+        p0, p1 = self.p_edges[i], self.p_edges[i+1]
+        v0, v1 = self.v_edges[i], self.v_edges[i+1]
+        c2 = (3 * (p1 - p0) - (2 * v0 + v1) * T) / T**2
+        c3 = (2 * (p0 - p1) + (v0 + v1) * T) / T**3
+        pos = p0 + v0 * s + c2 * s**2 + c3 * s**3
+        vel = v0 + 2 * c2 * s + 3 * c3 * s**2
+        acc = 2 * c2 + 6 * c3 * s
+        inside = (t >= self.t_edges[0]) & (t <= self.t_edges[-1])
+        return (pos, np.where(inside, vel, 0.0), np.where(inside, acc, 0.0))
+
+class SimPositioner:
+    def __init__(self, name, stagetype, params):
+        self.name = name
+        self.stagetype = stagetype
+        for key, value in params.items():
+            setattr(self, key, value)
+        # Motion history as (start time, profile); the last entry is current
+        self.history = [(0.0, SGammaProfile(self.position, self.position, 1.0, 1.0))]
+
+    def move(self, target, t0, extra_time=0.0):
+        pos = self.sample(t0)[0]
+        profile = SGammaProfile(pos, target, self.velocity, self.acceleration,
+                                self.min_jerk_time, t0 + extra_time)
+        self.history.append((t0, profile))
+        return profile.duration + extra_time
+
+    def run_trajectory(self, elements, t0):
+        pos = float(self.sample(t0)[0])
+        profile = PVTProfile(pos, elements, t0)
+        self.history.append((t0, profile))
+        return profile.duration
+
+    def hold(self, t0):
+        """Stop at the position reached at t0"""
+        pos = float(self.sample(t0)[0])
+        self.history.append((t0, SGammaProfile(pos, pos, 1.0, 1.0, t0=t0)))
+
+    def sample(self, t):
+        """Return (position, velocity, acceleration) at times t"""
+        t = np.asarray(t, dtype=float)
+        starts = np.array([s for s, _ in self.history])
+        index = np.searchsorted(starts, t, side='right') - 1
+        pos, vel, acc = np.zeros(t.shape), np.zeros(t.shape), np.zeros(t.shape)
+        for i in np.unique(index):
+            mask = index == i
+            p, v, a = self.history[max(i, 0)][1].sample(t[mask])
+            pos[mask], vel[mask], acc[mask] = p, v, a
+        return pos, vel, acc
+
+class SimGroup:
+    def __init__(self, name, positioners):
+        self.name = name
+        self.positioners = positioners
+        self.status = NOTINIT
+        self.abort = None           # asyncio.Event of the ongoing motion
+
+class SimFileStore:
+    """Local file store with the interface of SFTPWrapper
+
+    Files live under a root directory laid out like the controller,
+    e.g. root/Config/system.ini and root/Public/GATHERING.DAT.
+    """
+    def __init__(self, root):
+        self.root = root
+        self._cwd = root
+        self.host = None
+        self.username = None
+        self.password = None
+
+    def path(self, remotefile):
+        return os.path.join(self.root, remotefile)
+
+    def connect(self, host=None, username=None, password=None):
+        self.host = host
+        self.username = username
+        self.password = password
+        self._cwd = self.root
+
+    def close(self):
+        self._cwd = self.root
+
+    def cwd(self, remotedir):
+        path = os.path.join(self._cwd, remotedir)
+        if not os.path.isdir(path):
+            print('Error: Could not find path')
+            raise IOError('No such directory: {0}'.format(remotedir))
+        self._cwd = path
+
+    def stat(self, remotefile):
+        st = os.stat(os.path.join(self._cwd, remotefile))
+        return st.st_size, int(st.st_mtime)
+
+    def save(self, remotefile, localfile):
+        "Save a remote file to a local file"
+        shutil.copyfile(os.path.join(self._cwd, remotefile), localfile)
+
+    def put(self, localfile, remotefile):
+        shutil.copyfile(localfile, os.path.join(self._cwd, remotefile))
+        return True
+
+    def getlines(self, remotefile):
+        "Read text of a remote file"
+        with open(os.path.join(self._cwd, remotefile), 'rb') as f:
+            return str(f.read(), 'latin-1').split('\n')
+
+    def iterlines(self, remotefile, block_size=1 << 16):
+        with open(os.path.join(self._cwd, remotefile), 'rb') as f:
+            for line in iter_lines(f, block_size):
+                yield line
+
+    def iterarrays(self, remotefile, ncols, skiprows=0, block_size=1 << 20):
+        with open(os.path.join(self._cwd, remotefile), 'rb') as f:
+            for block in iter_arrays(f, ncols, skiprows, block_size):
+                yield block
+
+class XPSSimulator:
+    """TCP server emulating an XPS-D controller
+
+    Parameters
+    ----------
+    host, port : string, int
+        Address to listen on. Port 0 picks a free port.
+
+    systemini : string
+        Content of Config/system.ini defining the groups.
+
+    stages : dict
+        Per-positioner overrides of DEFAULT_STAGE, e.g.
+        {'MovingLinear.Pos': {'velocity': 5.0, 'acceleration': 20.0}}.
+
+    latency, jitter : float
+        Delay in seconds added to every reply: latency plus a uniform
+        random value in [-jitter, jitter] (never negative).
+
+    home_time : float
+        Extra duration of GroupHomeSearch in seconds.
+
+    servo_period : float
+        Servo cycle in seconds; gathering samples every divisor cycles.
+
+    root : string
+        Directory of the file store (a temporary directory by default).
+    """
+    def __init__(self, host='127.0.0.1', port=0, systemini=DEFAULT_SYSTEMINI,
+                 stages=None, latency=0.0, jitter=0.0, home_time=0.5,
+                 servo_period=1e-4, root=None, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.home_time = home_time
+        self.servo_period = servo_period
+        self.firmware_ver = 'XPS-D-N13016 Simulator'
+
+        self._random = random.Random(seed)
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._writers = set()
+
+        # Command statistics for benchmarking: counts per command and
+        # (received, replied, command) of the latest requests
+        self.counts = collections.Counter()
+        self.log = collections.deque(maxlen=100000)
+
+        if root is None:
+            self._tmpdir = tempfile.TemporaryDirectory(prefix='xpssim')
+            root = self._tmpdir.name
+        for sub in ('Config', 'Public', 'Public/Scripts', 'Public/Trajectories'):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+        self.filestore = SimFileStore(root)
+        with open(self.filestore.path('Config/system.ini'), 'w') as f:
+            f.write(systemini)
+
+        self.groups, self.positioners = self._parse_systemini(systemini, stages or {})
+        self.pvt_memory = {}
+        self.tcl_tasks = {}             # {task name : asyncio.Task}
+        self._reset_gathering()
+
+    ## Configuration
+    @staticmethod
+    def _parse_systemini(systemini, stages):
+        conf = ConfigParser()
+        conf.read_string(systemini)
+        groups = collections.OrderedDict()
+        positioners = collections.OrderedDict()
+        for gtype, glist in conf.items('GROUPS'):
+            for gname in [g.strip() for g in glist.split(',') if g.strip()]:
+                posnames = [p.strip() for p in conf.get(gname, 'positionerinuse').split(',')]
+                members = []
+                for pname in posnames:
+                    fullname = '{0}.{1}'.format(gname, pname)
+                    params = dict(DEFAULT_STAGE)
+                    params.update(stages.get(fullname, {}))
+                    members.append(SimPositioner(fullname, conf.get(fullname, 'stagename'), params))
+                    positioners[fullname] = members[-1]
+                groups[gname] = SimGroup(gname, members)
+        return groups, positioners
+
+    def _reset_gathering(self):
+        self.gathering_types = None
+        self.gathering_t0 = None
+        self.gathering_stop = None
+        self.gathering_number = 0
+        self.gathering_divisor = 1
+
+    ## Server
+    async def start_server(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.host, self.port = self._server.sockets[0].getsockname()[:2]
+        return self.host, self.port
+
+    def start(self):
+        """Run the server in a background thread and return (host, port)"""
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='xpssim', daemon=True)
+        self._thread.start()
+        return asyncio.run_coroutine_threadsafe(self.start_server(), self._loop).result()
+
+    def stop(self):
+        if self._loop is None:
+            return
+
+        async def shutdown():
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        replies = asyncio.Queue()
+        sender = asyncio.ensure_future(self._send_replies(writer, replies))
+        buf = ''
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buf += data.decode(ENCODING)
+                # Requests are not terminated; a command ends at the
+                # closing parenthesis
+                while ')' in buf:
+                    command, buf = buf.split(')', 1)
+                    command = command.strip() + ')'
+                    received = time.monotonic()
+                    reply = await self.execute(command)
+                    delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+                    await replies.put((time.monotonic() + max(delay, 0.0),
+                                       received, command, reply))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            sender.cancel()
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _send_replies(self, writer, replies):
+        """Write the replies in order once their injected delay is over
+
+        The delay models the network, so it does not hold back the
+        execution of the next (pipelined) command.
+        """
+        while True:
+            send_at, received, command, reply = await replies.get()
+            delay = send_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            writer.write((reply + END_FLAG).encode(ENCODING))
+            await writer.drain()
+            self.log.append((received, time.monotonic(), command))
+
+    async def execute(self, command):
+        """Execute one command and return the reply without EndOfAPI"""
+        match = re.match(r'^\s*(\w+)\((.*)\)$', command, re.S)
+        if match is None:
+            return '{0},'.format(ERR_WRONG_FORMAT)
+        name, argstr = match.groups()
+        self.counts[name] += 1
+        args = [a.strip() for a in argstr.split(',')] if argstr.strip() else []
+        # Drop output placeholders such as int* or double*
+        args = [a for a in args if not a.endswith('*')]
+        handler = getattr(self, 'do_' + name, None)
+        if handler is None:
+            return '{0},'.format(ERR_UNKNOWN_COMMAND)
+        try:
+            outputs = await handler(*args)
+        except SimError as exc:
+            return '{0},'.format(exc.code)
+        except (TypeError, ValueError):
+            return '{0},'.format(ERR_PARAMETERS_NUMBER)
+        return ','.join(['0'] + [_format(v) for v in outputs or ()]) + ','
+
+    ## Helpers
+    def now(self):
+        return time.monotonic()
+
+    def group(self, name):
+        try:
+            return self.groups[name]
+        except KeyError:
+            raise SimError(ERR_GROUP_NAME)
+
+    def positioner(self, name):
+        try:
+            return self.positioners[name]
+        except KeyError:
+            raise SimError(ERR_POSITIONER_NAME)
+
+    async def _motion(self, group, duration, status_after):
+        """Block the calling socket for the duration of a motion"""
+        group.abort = asyncio.Event()
+        try:
+            await asyncio.wait_for(group.abort.wait(), timeout=duration)
+        except asyncio.TimeoutError:
+            group.status = status_after
+            return ()
+        finally:
+            group.abort = None
+        raise SimError(ERR_MOVE_ABORTED)
+
+    def _interrupt(self, group, status):
+        if group.abort is not None:
+            t = self.now()
+            for p in group.positioners:
+                p.hold(t)
+            group.abort.set()
+        group.status = status
+
+    ## Controller commands
+    async def do_Login(self, name, password):
+        return ()
+
+    async def do_FirmwareVersionGet(self):
+        return (self.firmware_ver,)
+
+    async def do_CloseAllOtherSockets(self):
+        return ()
+
+    async def do_Reboot(self):
+        for group in self.groups.values():
+            self._interrupt(group, NOTINIT)
+        self._reset_gathering()
+        # All sockets are dropped, once this reply is sent
+        asyncio.get_running_loop().call_later(self.latency + self.jitter + 0.05,
+                                              self._drop_connections, list(self._writers))
+        return ()
+
+    def _drop_connections(self, writers):
+        for writer in writers:
+            writer.close()
+
+    async def do_ElapsedTimeGet(self):
+        return (self.now(),)
+
+    ## Group commands
+    async def do_GroupKill(self, name):
+        self._interrupt(self.group(name), NOTINIT_KILLED)
+        return ()
+
+    async def do_GroupInitialize(self, name):
+        group = self.group(name)
+        if group.status not in (NOTINIT, NOTINIT_KILLED):
+            raise SimError(ERR_NOT_ALLOWED)
+        group.status = NOTREF
+        return ()
+
+    async def do_GroupInitializeWithEncoderCalibration(self, name):
+        return await self.do_GroupInitialize(name)
+
+    async def do_GroupHomeSearch(self, name):
+        group = self.group(name)
+        if group.status != NOTREF:
+            raise SimError(ERR_NOT_ALLOWED)
+        group.status = HOMING
+        t0 = self.now()
+        duration = max(p.move(float(np.clip(0.0, p.min_target, p.max_target)), t0, self.home_time)
+                       for p in group.positioners)
+        return await self._motion(group, duration, READY_HOMED)
+
+    async def _move(self, name, values, relative):
+        group = self.group(name)
+        if len(values) != len(group.positioners):
+            raise SimError(ERR_PARAMETERS_NUMBER)
+        if group.status not in READY_STATES:
+            raise SimError(ERR_NOT_ALLOWED)
+        t0 = self.now()
+        targets = []
+        for p, value in zip(group.positioners, values):
+            target = float(value) + (float(p.sample(t0)[0]) if relative else 0.0)
+            if not p.min_target <= target <= p.max_target:
+                raise SimError(ERR_OUT_OF_RANGE)
+            targets.append(target)
+        group.status = MOVING
+        duration = max(p.move(target, t0) for p, target in zip(group.positioners, targets))
+        return await self._motion(group, duration, READY_MOTION)
+
+    async def do_GroupMoveAbsolute(self, name, *values):
+        return await self._move(name, values, relative=False)
+
+    async def do_GroupMoveRelative(self, name, *values):
+        return await self._move(name, values, relative=True)
+
+    async def do_GroupMoveAbort(self, name):
+        group = self.group(name)
+        if group.status not in (MOVING, TRAJECTORY):     # not homing, as the XPS
+            raise SimError(ERR_NOT_ALLOWED)
+        self._interrupt(group, READY_ABORTED)
+        return ()
+
+    async def do_GroupMotionDisable(self, name):
+        group = self.group(name)
+        if group.status not in READY_STATES:
+            raise SimError(ERR_NOT_ALLOWED)
+        group.status = DISABLED
+        return ()
+
+    async def do_GroupMotionEnable(self, name):
+        group = self.group(name)
+        if group.status != DISABLED:
+            raise SimError(ERR_NOT_ALLOWED)
+        group.status = READY_ENABLED
+        return ()
+
+    async def do_GroupStatusGet(self, name):
+        return (self.group(name).status,)
+
+    async def do_GroupStatusStringGet(self, code):
+        try:
+            return (STATUS_STRINGS[int(code)],)
+        except KeyError:
+            raise SimError(ERR_OUT_OF_RANGE)
+
+    async def do_GroupPositionSetpointGet(self, name):
+        t = self.now()
+        return tuple(float(p.sample(t)[0]) for p in self.group(name).positioners)
+
+    async def do_GroupPositionCurrentGet(self, name):
+        return await self.do_GroupPositionSetpointGet(name)
+
+    ## Positioner commands
+    async def do_PositionerMaximumVelocityAndAccelerationGet(self, name):
+        p = self.positioner(name)
+        return (p.max_velocity, p.max_acceleration)
+
+    async def do_PositionerUserTravelLimitsGet(self, name):
+        p = self.positioner(name)
+        return (p.min_target, p.max_target)
+
+    async def do_PositionerSGammaParametersGet(self, name):
+        p = self.positioner(name)
+        return (p.velocity, p.acceleration, p.min_jerk_time, p.max_jerk_time)
+
+    async def do_PositionerSGammaParametersSet(self, name, vel, acc, min_jerk, max_jerk):
+        p = self.positioner(name)
+        vel, acc, min_jerk, max_jerk = float(vel), float(acc), float(min_jerk), float(max_jerk)
+        if not (0 < vel <= p.max_velocity and 0 < acc <= p.max_acceleration
+                and 0 <= min_jerk <= max_jerk):
+            raise SimError(ERR_OUT_OF_RANGE)
+        p.velocity, p.acceleration = vel, acc
+        p.min_jerk_time, p.max_jerk_time = min_jerk, max_jerk
+        return ()
+
+    ## PVT trajectories
+    # Unlike the controller, any group (not only MultipleAxes groups)
+    # accepts PVT trajectories.
+    def _pvt_elements(self, name, filename):
+        """Elements of a trajectory as an array (nb_elements, 1 + 2*nb_positioners)"""
+        group = self.group(name)
+        if filename == 'FromMemory':
+            lines = self.pvt_memory.get(name, [])
+        else:
+            path = self.filestore.path(os.path.join('Public', 'Trajectories', filename))
+            if not os.path.isfile(path):
+                raise SimError(ERR_WRONG_FORMAT)
+            with open(path) as f:
+                lines = [l for l in f.read().split('\n') if l.strip()]
+        try:
+            elements = np.array([[float(v) for v in l.split(',')] for l in lines])
+        except ValueError:
+            raise SimError(ERR_WRONG_FORMAT)
+        if elements.ndim != 2 or elements.shape[1] != 1 + 2 * len(group.positioners):
+            raise SimError(ERR_WRONG_FORMAT)
+        return elements
+
+    async def do_MultipleAxesPVTResetInMemory(self, name):
+        self.group(name)
+        self.pvt_memory[name] = []
+        return ()
+
+    async def do_MultipleAxesPVTLoadToMemory(self, name, *part):
+        self.group(name)
+        lines = ','.join(part).split('\n')
+        self.pvt_memory.setdefault(name, []).extend(l.strip() for l in lines if l.strip())
+        return ()
+
+    async def do_MultipleAxesPVTVerification(self, name, filename):
+        group = self.group(name)
+        elements = self._pvt_elements(name, filename)
+        t = self.now()
+        for k, p in enumerate(group.positioners):
+            profile = PVTProfile(float(p.sample(t)[0]), elements[:, [0, 2*k+1, 2*k+2]])
+            pos, vel, _ = profile.sample(np.linspace(0, profile.duration, 50 * len(elements)))
+            if (pos.min() < p.min_target or pos.max() > p.max_target
+                    or np.abs(vel).max() > p.max_velocity):
+                raise SimError(ERR_OUT_OF_RANGE)
+        return ()
+
+    async def do_MultipleAxesPVTExecution(self, name, filename, number):
+        group = self.group(name)
+        if group.status not in READY_STATES:
+            raise SimError(ERR_NOT_ALLOWED)
+        elements = np.tile(self._pvt_elements(name, filename), (int(number), 1))
+        group.status = TRAJECTORY
+        t0 = self.now()
+        duration = max(p.run_trajectory(elements[:, [0, 2*k+1, 2*k+2]], t0)
+                       for k, p in enumerate(group.positioners))
+        return await self._motion(group, duration, READY_MOTION)
+
+    ## TCL scripts
+    # The controller embeds a TCL interpreter.  The simulator only runs
+    # the top-level statements of the scan scripts of NewportXPS:
+    #     set Name value        value may be [lindex $tcl_argv N]
+    #     Call Command args     an XPS function; on error, Save the
+    #                           error message and end the script
+    #     Stamp                 append ElapsedTimeGet to $Stamps
+    #     Save $Stamps          write $RunID and the stamps to $StampsFile
+    # Procedure bodies and all other statements are skipped.
+    def _tcl_path(self, filename):
+        if filename.startswith(XPS_HOME + '/'):
+            filename = filename[len(XPS_HOME) + 1:]
+        return self.filestore.path(filename)
+
+    def _tcl_save(self, variables, lines):
+        with open(self._tcl_path(variables['StampsFile']), 'w') as f:
+            for line in [variables.get('RunID', '')] + lines:
+                f.write('{0}\n'.format(line))
+
+    async def _run_tcl(self, lines, params):
+        variables = {}
+        stamps = []
+        depth = 0
+        for line in lines:
+            words = line.split()
+            top = depth == 0
+            depth += line.count('{') - line.count('}')
+            if not top or not words:
+                continue
+            if words[0] == 'set' and len(words) >= 3:
+                value = ' '.join(words[2:])
+                match = re.match(r'^\[lindex \$tcl_argv (\d+)\]$', value)
+                if match is not None:
+                    index = int(match.group(1))
+                    value = params[index] if index < len(params) else ''
+                variables[words[1]] = value
+            elif words[0] == 'Call':
+                # TCLScriptKill ends the script, not the current motion
+                command = '{0}({1})'.format(words[1], ','.join(words[2:]))
+                reply = await asyncio.shield(self.execute(command))
+                code = reply.split(',', 1)[0]
+                if code != '0':
+                    self._tcl_save(variables, ['Error: {0} failed ({1})'.format(words[1], code)])
+                    return
+            elif words[0] == 'Stamp':
+                stamps.append(_format(self.now()))
+            elif words[0] == 'Save':
+                self._tcl_save(variables, stamps)
+
+    async def do_TCLScriptExecute(self, filename, task, *params):
+        path = self.filestore.path(os.path.join('Public', 'Scripts', filename))
+        if not os.path.isfile(path):
+            raise SimError(ERR_WRONG_FORMAT)
+        running = self.tcl_tasks.get(task)
+        if running is not None and not running.done():
+            raise SimError(ERR_NOT_ALLOWED)
+        with open(path) as f:
+            lines = f.read().split('\n')
+        params = ' '.join(params).split()
+        self.tcl_tasks[task] = asyncio.ensure_future(self._run_tcl(lines, params))
+        return ()
+
+    async def do_TCLScriptKill(self, task):
+        running = self.tcl_tasks.get(task)
+        if running is None or running.done():
+            raise SimError(ERR_NOT_ALLOWED)
+        running.cancel()
+        return ()
+
+    async def do_TCLScriptRunningListGet(self):
+        return (','.join(name for name, t in self.tcl_tasks.items() if not t.done()),)
+
+    ## Gathering
+    def gathering_count(self, t=None):
+        """Number of samples gathered so far"""
+        if self.gathering_t0 is None:
+            return 0
+        if self.gathering_stop is not None:
+            t = self.gathering_stop
+        elif t is None:
+            t = self.now()
+        period = self.gathering_divisor * self.servo_period
+        return int(min(self.gathering_number, (t - self.gathering_t0) // period + 1))
+
+    def gathering_data(self, start, stop):
+        """Gathered values of samples start..stop-1 as a 2-D array"""
+        period = self.gathering_divisor * self.servo_period
+        t = self.gathering_t0 + period * np.arange(start, stop)
+        columns = []
+        for gtype in self.gathering_types:
+            pname, kind = gtype.rsplit('.', 1)
+            pos, vel, acc = self.positioners[pname].sample(t)
+            columns.append({'Position': pos, 'Velocity': vel, 'Acceleration': acc}[
+                           kind.replace('Current', '').replace('Setpoint', '')])
+        return np.column_stack(columns)
+
+    async def do_GatheringConfigurationSet(self, *types):
+        for gtype in types:
+            pname, _, kind = gtype.rpartition('.')
+            if pname not in self.positioners or kind not in GATHERING_TYPES:
+                raise SimError(ERR_GATHERING_TYPE)
+        self._reset_gathering()
+        self.gathering_types = list(types)
+        return ()
+
+    async def do_GatheringConfigurationGet(self):
+        if self.gathering_types is None:
+            raise SimError(ERR_GATHERING_NOT_CONFIGURED)
+        return (';'.join(self.gathering_types),)
+
+    async def do_GatheringRun(self, number, divisor):
+        if self.gathering_types is None:
+            raise SimError(ERR_GATHERING_NOT_CONFIGURED)
+        number, divisor = int(number), int(divisor)
+        if number < 1 or divisor < 1:
+            raise SimError(ERR_OUT_OF_RANGE)
+        self.gathering_number = number
+        self.gathering_divisor = divisor
+        self.gathering_t0 = self.now()
+        self.gathering_stop = None
+        return ()
+
+    async def do_GatheringStop(self):
+        if self.gathering_t0 is None:
+            raise SimError(ERR_GATHERING_NOT_STARTED)
+        if self.gathering_stop is None:
+            self.gathering_stop = self.now()
+        return ()
+
+    async def do_GatheringStopAndSave(self):
+        await self.do_GatheringStop()
+        data = self.gathering_data(0, self.gathering_count())
+        with open(self.filestore.path('Public/GATHERING.DAT'), 'w') as f:
+            f.write('\t'.join(self.gathering_types) + '\n')
+            np.savetxt(f, data, fmt='%.10g', delimiter='\t')
+        return ()
+
+    async def do_GatheringCurrentNumberGet(self):
+        return (self.gathering_count(), self.gathering_number)
+
+    async def do_GatheringDataGet(self, index):
+        return await self.do_GatheringDataMultipleLinesGet(index, 1)
+
+    async def do_GatheringDataMultipleLinesGet(self, index, number):
+        index, number = int(index), int(number)
+        if self.gathering_t0 is None:
+            raise SimError(ERR_GATHERING_NOT_STARTED)
+        if index < 0 or number < 1 or index + number > self.gathering_count():
+            raise SimError(ERR_OUT_OF_RANGE)
+        data = self.gathering_data(index, index + number)
+        return ('\n'.join(';'.join(_format(v) for v in row) for row in data),)
+
+def _format(value):
+    if isinstance(value, (float, np.floating)):
+        return '{0:.10g}'.format(value)
+    return str(value)
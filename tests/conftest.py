@@ -0,0 +1,25 @@
+# Fixtures running the tests against XPSSimulator on an ephemeral port
+
+import pytest
+
+from alicptfts.newportxps import NewportXPS
+from alicptfts.xpssim import XPSSimulator
+
+# Fast stage and homing, so that a scan takes a fraction of a second
+FAST_STAGES = {'MovingLinear.Pos': dict(velocity=20.0, acceleration=400.0,
+                                        max_velocity=50.0, max_acceleration=1000.0,
+                                        min_jerk_time=0.001, max_jerk_time=0.002)}
+
+@pytest.fixture
+def sim(tmp_path):
+    sim = XPSSimulator(stages=FAST_STAGES, home_time=0.01, root=str(tmp_path / 'xps'))
+    sim.start()
+    yield sim
+    sim.stop()
+
+@pytest.fixture
+def xps(sim, tmp_path):
+    xps = NewportXPS(sim.host, sim.port, ftpconn=sim.filestore,
+                     cache_dir=str(tmp_path / 'cache'))
+    yield xps
+    xps.close()
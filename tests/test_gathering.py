@@ -0,0 +1,49 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from alicptfts.gathering import read_gathering
+
+TYPES = ['MovingLinear.Pos.CurrentPosition', 'GPIO2.DI']
+
+def write(fname, rows, mtime=None):
+    with open(fname, 'w') as f:
+        f.write('\t'.join(TYPES) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(v) for v in row) + '\n')
+    if mtime is not None:
+        os.utime(fname, (mtime, mtime))
+
+def test_read_gathering(tmp_path):
+    fname = str(tmp_path / 'GATHERING.DAT')
+    with open(fname, 'w') as f:
+        f.write('\t'.join(TYPES) + '\n1.5\t3\n\n2.5\t4\n')
+    data = read_gathering(fname, types=TYPES, chunk_size=8)    # lines split across chunks
+    assert data.dtype['GPIO2.DI'] == np.int32
+    assert list(data['CurrentPosition']) == [1.5, 2.5]
+    assert list(data['GPIO2.DI']) == [3, 4]
+
+def test_read_gathering_invalid(tmp_path):
+    fname = str(tmp_path / 'GATHERING.DAT')
+    with open(fname, 'w') as f:
+        f.write('\t'.join(TYPES) + '\n1.5\t3\n2.5\tx\n')
+    with pytest.raises(ValueError):
+        read_gathering(fname, cache=False)
+
+def test_read_gathering_sidecar(tmp_path):
+    fname = str(tmp_path / 'GATHERING.DAT')
+    write(fname, [(1.0, 1), (2.0, 2)])
+    read_gathering(fname)
+    data = read_gathering(fname, types=TYPES)
+    assert isinstance(data, np.memmap)      # from the sidecar
+
+    with pytest.raises(ValueError):         # other types: parsed again and checked
+        read_gathering(fname, types=TYPES[::-1])
+
+    # Replaced by a copy older than the sidecar
+    other = str(tmp_path / 'OTHER.DAT')
+    write(other, [(5.0, 5), (6.0, 6), (7.0, 7)], mtime=1)
+    shutil.copy2(other, fname)
+    assert list(read_gathering(fname)['CurrentPosition']) == [5.0, 6.0, 7.0]
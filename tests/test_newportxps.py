@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from alicptfts.newportxps import NewportXPS, XPSException
+
+def test_read_systemini(xps):
+    assert list(xps.groups) == ['PointingLinear', 'PointingRotary', 'MovingLinear']
+    assert xps.groups['MovingLinear']['positioners'] == ['Pos']
+    assert xps.stages['MovingLinear.Pos']['max_target'] == 12.5
+
+def test_read_systemini_cache(sim, xps):
+    assert os.listdir(xps.cache_dir) == ['xps_{0}_{1}.json'.format(sim.host, sim.port)]
+    groups, stages = dict(xps.groups), dict(xps.stages)
+
+    sim.counts.clear()
+    xps.groups['Stale'] = {}
+    xps.connect(new_socket=False)           # unchanged files: from the cache
+    assert sim.counts['PositionerUserTravelLimitsGet'] == 0
+    assert dict(xps.groups) == groups and dict(xps.stages) == stages
+
+    ini = sim.filestore.path('Config/system.ini')
+    with open(ini) as f:
+        text = f.read()
+    with open(ini, 'w') as f:
+        f.write(text.replace('[MovingLinear.Pos]', '[MovingLinear.Pos]\n; changed'))
+    os.utime(ini, (time.time() + 10, time.time() + 10))
+    xps.groups['Stale'] = {}
+    xps.connect(new_socket=False)           # changed content: parsed again
+    assert sim.counts['PositionerUserTravelLimitsGet'] == 3
+    assert dict(xps.groups) == groups and dict(xps.stages) == stages
+
+@pytest.mark.parametrize('mode', ['legs', 'pvt', 'tcl'])
+def test_scan(sim, xps, mode):
+    blocks = []
+    timestamps = xps.scan([-1, 1], 1, callback=blocks.append, mode=mode)
+    assert len(timestamps) == 6 and np.all(np.diff(timestamps) >= 0)
+
+    data = np.loadtxt(sim.filestore.path('Public/GATHERING.DAT'), skiprows=1)
+    assert np.array_equal(np.concatenate(blocks), data)
+    setpoint = data[:, 3]
+    legs = xps.leg_indices
+    assert len(legs) == 5                   # four sweeps and back to the origin
+    assert np.allclose(setpoint[legs[:-1, 1]], [1, -1, 1, -1], atol=1e-3)
+    assert np.isclose(setpoint[legs[-1, 1]], 0.0, atol=1e-3)
+    if mode == 'pvt':
+        report = xps.scan_report
+        assert report['nb_sweeps'] == 4
+        assert abs(report['achieved_duty_cycle'] - report['predicted_duty_cycle']) < 0.05
+
+def test_scan_failure_stops_gathering(sim, xps):
+    def fail(*args):
+        raise RuntimeError('leg failed')
+    xps._scan_legs = fail
+    with pytest.raises(RuntimeError):
+        xps.scan([-1, 1], 1)
+    assert sim.counts['GatheringStop'] == 1
+
+def test_stop_all_aborts_motion(sim, xps):
+    move = threading.Thread(target=lambda: pytest.raises(XPSException, xps.move_group,
+                                                         'MovingLinear', 10.0, 1))
+    move.start()
+    time.sleep(0.1)
+    assert xps.stop_all() < 0.5
+    move.join()
+    assert sim.groups['MovingLinear'].status == 10      # ready after an abort
+    assert xps.killed_groups == []
+
+def test_stop_all_kills_homing(sim, xps):
+    sim.home_time = 5.0
+    xps.kill_group('PointingLinear')
+    home = threading.Thread(target=lambda: pytest.raises(XPSException, xps.initialize_group,
+                                                         'PointingLinear'))
+    home.start()
+    time.sleep(0.1)
+    assert sim.groups['PointingLinear'].status == 43
+    xps.stop_all()
+    home.join()
+    assert xps.killed_groups == ['PointingLinear']
+    assert sim.groups['PointingLinear'].status == 7     # killed
+
+def test_reboot_reopens_sockets(sim, xps):
+    xps.reboot()
+    assert len(xps._xps._query) == xps._xps.nb_query and xps._xps._abort is not None
+    assert 'Not initialized' in xps.status()
+    xps.initialize()
+    assert all(sim.groups[g].status == 11 for g in xps.groups)
+
+def test_warm_connect(sim, tmp_path):
+    sim.counts.clear()
+    first = NewportXPS(sim.host, sim.port, ftpconn=sim.filestore, cache_dir=None)
+    first.close()
+    homed = sim.counts['GroupHomeSearch']
+    second = NewportXPS(sim.host, sim.port, ftpconn=sim.filestore, cache_dir=None, warm=True)
+    second.close()
+    assert sim.counts['GroupHomeSearch'] == homed
@@ -0,0 +1,87 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from alicptfts.xpsclient import XPS, ReplyOutOfStep, ReplyReader, parse_reply
+
+def test_parse_reply():
+    assert parse_reply(b'0,11,EndOfAPI', (int,)) == (0, 11, '')
+    assert parse_reply('0,-12.5,12.5,', (float, float)) == (0, -12.5, 12.5, '')
+    assert parse_reply('0,XPS-D, Simulator,', (str,)) == (0, 'XPS-D, Simulator', '')
+    assert parse_reply('-22,', (int,)) == (-22, None, '-22')
+    res, value, err = parse_reply('0,abc,', (int,))
+    assert res == -1 and value is None and 'abc' in err
+    res, value, err = parse_reply('0,', (int,))
+    assert res == -1 and 'Missing' in err
+
+def read_replies(chunks, nb_replies, size):
+    """Replies read by a ReplyReader from chunks sent on a socket pair"""
+    async def main():
+        ours, theirs = socket.socketpair()
+        ours.setblocking(False)
+        reader = ReplyReader(size)
+        reader.sent(nb_replies)
+        try:
+            for chunk in chunks:
+                theirs.sendall(chunk)
+            return [await reader.read(ours, 1.0) for _ in range(nb_replies)], reader
+        finally:
+            ours.close()
+            theirs.close()
+    return asyncio.run(main())
+
+def test_reply_reader_split_chunks():
+    chunks = [b'0,1End', b'OfAPI0,2,', b'3EndOf', b'A', b'PI0,', b'4' * 40 + b'EndOfAPI']
+    replies, reader = read_replies(chunks, 3, size=16)     # the buffer has to grow
+    assert replies == [b'0,1', b'0,2,3', b'0,' + b'4' * 40]
+    assert reader.pending == 0
+
+def test_reply_reader_out_of_step():
+    reader = ReplyReader()
+    with pytest.raises(ReplyOutOfStep):
+        asyncio.run(reader.read(None))      # no request is waiting
+    reader.free_space()[:10] = b'0,EndOfAPI'
+    reader.advance(10)
+    with pytest.raises(ReplyOutOfStep):
+        reader.sent()                       # a reply nobody asked for
+    assert reader.pending == 0
+
+@pytest.fixture
+def client(sim):
+    xps = XPS()
+    assert xps.OpenInstrument(sim.host, sim.port, 100) == 0
+    yield xps
+    xps.CloseInstrument()
+
+def test_batch(client):
+    calls = [('GroupStatusGet', ('MovingLinear', 0, '')),
+             ('PositionerUserTravelLimitsGet', ('MovingLinear.Pos', 0, 0, '')),
+             ('FirmwareVersionGet', ('', ''))]
+    replies = client.batch(calls * 50)      # more than one BATCH_WINDOW
+    expected = [getattr(client, method)(*args) for method, args in calls]
+    assert replies == expected * 50
+    assert expected[1] == (0, -12.5, 12.5, '')
+
+def test_timeout_then_next_command(sim, client):
+    firmware = client.FirmwareVersionGet('', '')
+    limits = client.PositionerUserTravelLimitsGet('MovingLinear.Pos', 0, 0, '')
+    sim.latency = 0.3                       # longer than the 100 ms timeout
+    res, version, err = client.FirmwareVersionGet('', '')
+    assert res == -1 and 'Timeout' in err
+    sim.latency = 0.0
+    time.sleep(0.3)                         # the late reply arrives
+    # The late reply is dropped, not taken for the reply of the next command
+    assert client.PositionerUserTravelLimitsGet('MovingLinear.Pos', 0, 0, '') == limits
+    assert client.FirmwareVersionGet('', '') == firmware
+
+def test_timeout_in_batch(sim, client):
+    calls = [('FirmwareVersionGet', ('', '')),
+             ('PositionerUserTravelLimitsGet', ('MovingLinear.Pos', 0, 0, ''))]
+    expected = client.batch(calls)
+    sim.latency = 0.3
+    assert all(reply[0] == -1 for reply in client.batch(calls))
+    sim.latency = 0.0
+    time.sleep(0.3)
+    assert client.batch(calls[::-1]) == expected[::-1]